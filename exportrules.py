@@ -0,0 +1,67 @@
+from naturalnum import *
+import glob
+import json
+import os
+import sys
+
+## Values recorded in golden files, checked against site/naturalnum.js
+goldenValues = [str(x) for x in range(0, 121)] + ["199", "200", "201", "999", 
+	"1000", "1001", "1010", "1100", "1234", "2000", "9999", "10000", "12345", 
+	"70071", "80081", "99999", "100000", "123456", "999999"]
+
+def exportrules():
+	"""Exports each .lang file given on the command line as a portable rule 
+		table (see RuleEngine.exportTable) to the output directory, named by
+		locale and content hash so that it can be served with long-lived cache
+		headers, along with an index.json naming the current file per locale.
+		With --golden, writes expected results for goldenValues instead.
+	"""
+	if len(sys.argv) < 3:
+		usage()
+		return 2
+	if sys.argv[1] == "--golden":
+		writeGolden(sys.argv[2], sys.argv[3:])
+		return 0
+	outDir = sys.argv[1]
+	indexFileName = os.path.join(outDir, "index.json")
+	index = {"version": exportFormatVersion, "locales": {}}
+	if os.path.exists(indexFileName):
+		f = open(indexFileName, "r")
+		index["locales"] = json.load(f)["locales"]
+		f.close()
+	for langFileName in sys.argv[2:]:
+		locale = os.path.splitext(os.path.basename(langFileName))[0]
+		table = RuleEngine.fromLangFilename(langFileName).exportTable()
+		tableFileName = locale + "." + table["contentHash"][0:12] + ".json"
+		for old in glob.glob(os.path.join(outDir, locale + ".*.json")):
+			os.remove(old)
+		writeJson(os.path.join(outDir, tableFileName), table, compact=True)
+		index["locales"][locale] = tableFileName
+		print(locale + " -> " + tableFileName)
+	writeJson(indexFileName, index)
+	return 0
+
+def writeGolden(goldenFileName, langFileNames):
+	golden = {}
+	for langFileName in langFileNames:
+		locale = os.path.splitext(os.path.basename(langFileName))[0]
+		eng = RuleEngine.fromLangFilename(langFileName)
+		golden[locale] = [[value, eng.resolve(value), eng.render(value)] 
+			for value in goldenValues]
+	writeJson(goldenFileName, golden)
+
+def writeJson(fileName, data, compact=False):
+	f = open(fileName, "w")
+	if compact:
+		json.dump(data, f, sort_keys=True, separators=(",", ":"))
+	else:
+		json.dump(data, f, sort_keys=True, indent=1)
+	f.write("\n")
+	f.close()
+
+def usage():
+	print("Usage: exportrules.py <output dir> <lang file> [<lang file> ...]")
+	print("       exportrules.py --golden <golden file> <lang file> [<lang file> ...]")
+
+if __name__ == '__main__':
+	sys.exit(exportrules())
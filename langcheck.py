@@ -0,0 +1,25 @@
+from naturalnum import *
+import sys
+
+def langcheck():
+	"""Validates each .lang file given on the command line, printing every 
+		error found.  Exits with status 1 if any file has errors, so it can be
+		used as a CI check.
+	"""
+	if len(sys.argv) < 2:
+		usage()
+		return 2
+	errorCount = 0
+	for fileName in sys.argv[1:]:
+		for error in checkLangFile(fileName):
+			print(str(error))
+			errorCount = errorCount + 1
+	if errorCount > 0:
+		return 1
+	return 0
+
+def usage():
+	print("Usage: langcheck.py <lang file> [<lang file> ...]")
+
+if __name__ == '__main__':
+	sys.exit(langcheck())
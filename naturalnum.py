@@ -1,10 +1,83 @@
 import re
+import os
+import mmap
+import json
+import hashlib
+import itertools
+import time
+import random
+import threading
+import sys
 import logging
+import collections
+try:
+	from urllib.parse import parse_qs
+except ImportError:
+	from urlparse import parse_qs
 
 lhsValidatorRegex = r"[0-9a-zA-Z]+"
-rhsValidatorRegex = r"[0-9a-zA-Z\(\),\$-]+"  ## Only alphanumerics (inc. hyphen) or these chars: (),$
+rhsValidatorRegex = r"[0-9a-zA-Z\(\),\$+-]+" ## Only alphanumerics (inc. hyphen) or these chars: (),$+
 ruleValidatorRegex = r".+=.+"               ## At least one char each side of '=' delimiter
 rhsPlaceholderRegex = r"\$[A-Za-z]"         ## A '$' followed by an alpha char
+rhsDelimiterRegex = r"([,+])"               ## ',' separates words, '+' joins within a word
+directiveValidatorRegex = r"@([a-z]+)=(.*)$" ## '@' directive name, '=', then value
+
+## Patterns used when validating rules, compiled once rather than per rule
+rhsPlaceholderPattern = re.compile(rhsPlaceholderRegex)
+rhsBadPlaceholderPattern = re.compile(r"\$(?![A-Za-z])")   ## A '$' not followed by an alpha char
+withinBracketsPattern = re.compile(r"\(.*?\)")
+digitsOrDigivarsPattern = re.compile(r"^(\$[a-zA-Z]|[0-9])+$")
+rhsDelimiterPattern = re.compile(rhsDelimiterRegex)
+backrefPattern = re.compile(r"\\g<([0-9]+)>")
+
+## Kinds of step in a RuleEngine's compiled plan for a rule's rhs tokens
+tokenLiteral = 0    ## Expand digivars in the token and output it
+tokenRecurse = 1    ## Expand digivars and feed the result back through the engine
+tokenFixed = 2      ## Recursive token with no digivars, already resolved
+tokenTable = 3      ## Recursive token, resolved for each value of its digivars
+
+## Version of the portable rule table format written by RuleEngine.exportTable()
+exportFormatVersion = 1
+
+## Recursive tokens with up to this many digivars are tabled at load time
+inlineMaxDigivars = 2
+## Fragments needing deeper recursion than this are left out of those tables
+inlineMaxDepth = 64
+## Resolving a value recursing deeper than this raises RuleEvaluationException
+resolveMaxDepth = 100
+## Recursive tokens whose value may map to itself are checked for up to this
+## many independent digits (see RuleGraph.identityValue)
+identityMaxDigivars = 3
+
+## Rendering directives which may be declared in a .lang file, with defaults
+directiveDefaults = {"separator": " ", "joiner": ""}
+## Directive naming the locale a .lang file overlays, e.g. @base=fr_FR
+baseDirective = "base"
+localePattern = re.compile(r"[A-Za-z0-9_-]+\Z")
+
+## Bulk (byte buffer) input: non-empty lines, optionally CR-terminated, and
+## the digits-only check applied to each line in place.
+bulkLinePattern = re.compile(b"[^\\n]+")
+bulkDigitsPattern = re.compile(b"[0-9]+\\r?$")
+## Most recently used results kept while resolving a buffer
+bulkMemoSize = 4096
+
+## SqliteResolutionCache: most recently used results also kept in memory, and
+## the number of rule set versions per locale whose entries are kept
+cacheMemorySize = 4096
+cacheKeepVersions = 3
+
+## Values accepted by a RuleEngine with a ResolutionBudget
+valueValidatorPattern = re.compile(r"[0-9]+\Z")
+
+## Access log lines: the query string of a request, and its status if logged
+accessLogPattern = re.compile(r'"(?:GET|HEAD) [^"?\s]*\?([^"\s]*)[^"]*"(?: ([0-9]{3}))?')
+
+## Range aggregation: a set of digits is a bitmask, bit d set if d is allowed
+allDigitsMask = 0x3FF
+
+## Highest resolution clock available, for latency measurements
+timer = getattr(time, "perf_counter", time.time)
 
 ## Set up logging (users will set up their own handlers)
 class NullHandler(logging.Handler):
@@ -24,6 +97,7 @@ class Rule:
 	def __init__(self, lhs=None, rhs=None):
 		self.lhs = lhs
 		self.rhs = rhs
+		self.lineNumber = None    ## Set when parsed from a .lang file
 
 	def init(self):
 		self.validateLhs()
@@ -46,103 +120,107 @@ class Rule:
 		# Ensure lhs is present
 		if (self.lhs == None or self.lhs == ""):
 			raise RuleValidationException("Could not validate lhs of Rule: [" + 
-				"" if self.lhs is None else self.lhs + "] because it is empty.")
+				"" if self.lhs is None else self.lhs + "] because it is empty.", 0)
 
 		# Ensure lhs is alphanumeric only
 		if (re.match(lhsValidatorRegex, self.lhs) == None):
 			raise RuleValidationException("Could not validate lhs of Rule: [" + 
-				self.lhs + "].  Only alpha/digits allowed.")
+				self.lhs + "].  Only alpha/digits allowed.", 0)
 	
 		# If alpha chars present, ensure they are unique
 		if(not self.lhs.isdigit()):
-			alphas = [x for x in self.lhs if not x.isdigit()]
-			if len(set(alphas)) != len(alphas):
-				raise RuleValidationException("Could not validate lhs of Rule: [" + 
-					self.lhs + "].  Alpha characters must be unique.")
+			seen = set()
+			for pos, x in enumerate(self.lhs):
+				if x.isdigit():
+					continue
+				if x in seen:
+					raise RuleValidationException("Could not validate lhs of Rule: [" + 
+						self.lhs + "].  Alpha characters must be unique.", pos)
+				seen.add(x)
 
 	def splitRhsTokens(self):
-		"""Splits rhs string into a list of tokens, separated by ',' delimiter"""
-		self.rhsTokenList = self.rhsWithBackrefs.split(',')
+		"""Splits rhs string into a list of tokens, separated by ',' or '+'
+			delimiters.  The delimiter between each pair of tokens is kept in
+			rhsDelimiterList, for use when rendering.
+		"""
+		tokensAndDelimiters = rhsDelimiterPattern.split(self.rhsWithBackrefs)
+		self.rhsTokenList = tokensAndDelimiters[0::2]
+		self.rhsDelimiterList = tokensAndDelimiters[1::2]
 
 	def validateRhs(self):
 		"""Validates string in RHS of a rule.  All of the following must be true:
 			- Not empty or null
-			- Only alphanumeric chars, or any of: (),$
+			- Only alphanumeric chars, or any of: (),$+
 			- Brackets must be balanced
 			- Anything within brackets should resolve to digits
 		"""
 		# Check rhs is present
 		if (self.rhs == None or self.rhs == ""):
 			raise RuleValidationException("Could not validate rhs of Rule: [" +
-				"" if self.rhs is None else self.rhs + "] because it is empty.")
-	   
-		logger.debug("Validating rhs: " + self.rhs)
+				"" if self.rhs is None else self.rhs + "] because it is empty.",
+				self.rhsColumn(0))
 	
 		# Check only allowed chars present
 		if (re.match(rhsValidatorRegex, self.rhs) == None):
 			raise RuleValidationException("Could not validate rhs of Rule: [" + 
-				self.rhs + "].  Only alpha/digits or the following chars allowed: (),$")
+				self.rhs + "].  Only alpha/digits or the following chars allowed: (),$+",
+				self.rhsColumn(0))
 	
 		# Check '$' only precedes an alpha character
-		checkNextIsAlpha = False
-		for x in self.rhs:
-			if x == '$':	
-				checkNextIsAlpha = True
-			else:
-				if checkNextIsAlpha:
-					if not x.isalpha():
-						raise RuleValidationException("Could not validate rhs of Rule: [" + 
-							self.rhs + "].  '$' must always be folowed by an alpha char.")
-					checkNextIsAlpha = False
+		match = rhsBadPlaceholderPattern.search(self.rhs)
+		if match != None:
+			raise RuleValidationException("Could not validate rhs of Rule: [" + 
+				self.rhs + "].  '$' must always be folowed by an alpha char.",
+				self.rhsColumn(match.start()))
 					
 		# Ensure everything within brackets is either digits or digivars
-		withinBracketsSearchPatt = re.compile("\\(.*?\\)")  # todo move to constant
-		for match in re.finditer(withinBracketsSearchPatt, self.rhs):
+		for match in withinBracketsPattern.finditer(self.rhs):
 			matchedVal = self.rhs[match.start()+1:match.end()-1]
-			logger.debug("Checking rhs token within brackets [" + matchedVal + "] is digits or digivars")
-			digitsOrDigivarsPatt = re.compile("^(\\$[a-zA-Z]|[0-9])+$")  # todo move to constant
-			if digitsOrDigivarsPatt.match(matchedVal) == None:
+			if digitsOrDigivarsPattern.match(matchedVal) == None:
 				raise RuleValidationException \
-					("Bracketed terms must contain only digits or digivars")
+					("Bracketed terms must contain only digits or digivars",
+					self.rhsColumn(match.start()))
+
+	def rhsColumn(self, pos):
+		"""Returns the offset of position 'pos' in the rhs, within the whole
+			rule string '<lhs>=<rhs>'.
+		"""
+		if self.lhs == None:
+			return pos
+		return len(self.lhs) + 1 + pos
 
 	def validateRhsTokenList(self):
 		""""""
-		# Check that if brackets exist, they are at the start/end positions
-		
-		for token in self.rhsTokenList:
-			pos = 0
-			for x in token:
-				if x == '(' and not pos == 0: 				
-					raise RuleValidationException("Could not validate rhs token: [" + 
-						token + "] - can only start recursion at beginning of token.")
-				elif x == ')' and not pos == len(token)-1:
-					raise RuleValidationException("Could not validate rhs token: [" + 
-						token + "] - can only end recursion at end of token.")
-				pos = pos + 1
+		# Check that if brackets exist, they are at the start/end positions.
+		# Tokens are taken from the rhs as written (rather than rhsTokenList, 
+		# which holds backreferences) so that error positions match the rule.
+		offset = 0
+		for token in rhsDelimiterPattern.split(self.rhs)[0::2]:
+			pos = token.find('(', 1)
+			if pos != -1:
+				raise RuleValidationException("Could not validate rhs token: [" + 
+					token + "] - can only start recursion at beginning of token.",
+					self.rhsColumn(offset + pos))
+			pos = token.find(')', 0, len(token) - 1)
+			if pos != -1:
+				raise RuleValidationException("Could not validate rhs token: [" + 
+					token + "] - can only end recursion at end of token.",
+					self.rhsColumn(offset + pos))
+			offset = offset + len(token) + 1
 
 	def validateLhsWithRhs(self):
 		# Check all placeholders on RHS appear on LHS
 		# 1. Find set of all LHS placeholders
 		lhsPlaceholders = set([x for x in self.lhs if not x.isdigit()])
 
-		# 2. Find set of all RHS placeholders
-		placeholderDetected = False
-		rhsPlaceholdersList = []	
-		for x in self.rhs:
-			if x == '$':
-				placeholderDetected = True
-			else:
-				if placeholderDetected:
-					rhsPlaceholdersList.append(x)
-					placeholderDetected = False
-		rhsPlaceholders = set(rhsPlaceholdersList)
-	
-		# 3. Check RHS placeholders is a subset of LHS placeholders 
+		# 2. Check each RHS placeholder appears on the LHS 
 		# (not necessarily vice-versa)
-		if not rhsPlaceholders <= lhsPlaceholders:
-			raise RuleValidationException("Could not validate Rule lhs [" + 
-				self.lhs + "] with rhs: [" + self.rhs + 
-				"] - placeholder(s) on rhs do not appear on lhs.")
+		for match in rhsPlaceholderPattern.finditer(self.rhs):
+			if self.rhs[match.start()+1] not in lhsPlaceholders:
+				raise RuleValidationException("Could not validate Rule lhs [" + 
+					self.lhs + "] with rhs: [" + self.rhs + 
+					"] - placeholder(s) on rhs do not appear on lhs.",
+					self.rhsColumn(match.start()))
 		
 	def buildLhsRegex(self):
 		lhsRegex = "^"
@@ -194,9 +272,8 @@ class Rule:
 		## Replace all instances of "$<char>" in rhs expression with a 
 		## backreference to the group number matching that char in the LHS regex.
 		rhsWithBackrefs = self.rhs
-		rhsPlaceholderSearchPatt = re.compile(rhsPlaceholderRegex)
 
-		for match in re.finditer(rhsPlaceholderSearchPatt, self.rhs):
+		for match in rhsPlaceholderPattern.finditer(self.rhs):
 			matchedVal = self.rhs[match.start():match.end()]
 			backref = "\\g<" + str(self.lhsGroupDict[matchedVal[1:]]) + ">"
 			rhsWithBackrefs = rhsWithBackrefs.replace(matchedVal, backref)
@@ -221,8 +298,9 @@ class Rule:
 		return "[" + self.lhs + "=" + self.rhs + "], [" + self.lhsRegex + "=" + self.rhsWithBackrefs + "]"
 
 class RuleValidationException(Exception):
-	def __init__(self, value):
+	def __init__(self, value, column=None):
 		self.value = value
+		self.column = column    ## Offset of the error within the rule, if known
 	def __str__(self):
 		return repr(self.value)
 
@@ -238,9 +316,16 @@ class RuleEvaluationException(Exception):
 	def __str__(self):
 		return repr(self.value)
 
+class RuleBudgetException(RuleEvaluationException):
+	"""Raised when resolving a value exceeds the engine's ResolutionBudget."""
+	pass
+
 class RuleList:
 	def __init__(self):
 		self.rules = []
+		self.directives = dict(directiveDefaults)
+		self.declaredDirectives = set()
+		self.base = None
 		
 	def __len__(self):
 		return len(self.rules)
@@ -248,59 +333,1780 @@ class RuleList:
 	def add(self, rule):
 		self.rules.append(rule)
 
+	def setDirective(self, name, value):
+		self.directives[name] = value
+		self.declaredDirectives.add(name)
+
+	def inherit(self, base):
+		"""Makes this rule list an overlay on the RuleList 'base', sharing its
+			Rule objects.  A rule with the same lhs as a base rule replaces it,
+			in the base rule's place in search order.  Other rules keep their
+			order relative to those: each is searched straight after the rule
+			listed before it, or before all base rules if listed first.  So an
+			overlay may add a general rule (e.g. 7u) after its own exceptions
+			(e.g. 70, 71) without shadowing them.  Directives not declared 
+			here are taken from the base.
+		"""
+		baseLhs = set([rule.lhs for rule in base.rules])
+		overrides = {}
+		leading = []
+		following = {}    ## Added rules by the lhs of the override before them
+		previous = None
+		for rule in self.rules:
+			if rule.lhs in baseLhs:
+				if rule.lhs not in overrides:
+					overrides[rule.lhs] = rule
+				previous = rule.lhs
+			elif previous == None:
+				leading.append(rule)
+			else:
+				following.setdefault(previous, []).append(rule)
+		self.rules = leading
+		for rule in base.rules:
+			self.rules.append(overrides.get(rule.lhs, rule))
+			self.rules.extend(following.pop(rule.lhs, []))
+		for name in base.directives:
+			if name not in self.declaredDirectives:
+				self.directives[name] = base.directives[name]
+		self.base = base
+
+	def contentHash(self):
+		"""Returns a hex digest of the rules and directives, which changes
+			whenever the rule set would resolve values differently.
+		"""
+		digest = hashlib.sha1()
+		for name in sorted(self.directives):
+			digest.update(("@" + name + "=" + self.directives[name] + "\n").encode("utf-8"))
+		for rule in self.rules:
+			digest.update((rule.lhs + "=" + rule.rhs + "\n").encode("utf-8"))
+		return digest.hexdigest()
+
 	def search(self, value):
 		for rule in self.rules:
 			if rule.matches(value):
 				return rule			
 
 class RuleEngine:
-	def __init__(self, ruleList):
+	def __init__(self, ruleList, inline=True, base=None):
 		self.ruleList = ruleList
+		self.inline = inline
+		self.base = base
+		self.maxDepth = resolveMaxDepth
+		self.cache = None
+		self.asyncResolver = None
+		self.budget = None
+		self.inputsRejected = 0
+		self.budgetsExceeded = 0
+		self.compile()
+
+	def compile(self):
+		"""Prepares the engine for resolving values against its rule list.  This
+			must be called again if the rule list is modified.
+
+			Recursion between rules is checked (see RuleGraph), raising 
+			RuleValidationException if it cannot terminate.  Then each rule's 
+			rhs is compiled to a plan of (kind, template, data) steps.  Unless 
+			'inline' is False, recursive tokens are partially evaluated: a 
+			token with no digivars, e.g. (1), is resolved once and its result 
+			inlined into the plan, and one with up to inlineMaxDigivars 
+			digivars, e.g. ($t0), is replaced by a table of results for every 
+			value of its digivars.
+
+			If the engine has a 'base' engine (for a rule list which inherits
+			from the base's, see RuleList.inherit), the base's compiled plans 
+			are reused for every rule which resolves the same way in both, as
+			are its inlined tokens wherever they only recurse into such rules.
+			The base's rule index and recursion checks are shared likewise.
+		"""
+		self.compileRendering()
+		self.ruleGraph = RuleGraph(self.ruleList, 
+			None if self.base == None else self.base.ruleGraph)
+		self.ruleIndex = self.ruleGraph.index
+		if self.ruleGraph.errors:
+			raise RuleValidationException("Recursion errors in rule list:\n" +
+				"\n".join([message for rule, message in self.ruleGraph.errors]))
+		self.plans = {}
+		self.preloaded = {}
+		self.preloadedBytes = 0
+		self.lhsLengths = set([len(rule.lhs) for rule in self.ruleList.rules])
+		self.fragments = {}
+		self.aggregator = None
+		self.shared = shared = self.sharedRules()
+		for rule in self.ruleList.rules:
+			if rule in shared:
+				self.plans[rule] = self.base.plans[rule]
+			else:
+				self.plans[rule] = self.buildPlan(rule)
+		if self.inline:
+			self.maxDepth = inlineMaxDepth
+			try:
+				for rule in self.ruleList.rules:
+					if rule not in shared:
+						self.plans[rule] = self.inlinePlan(rule, self.plans[rule],
+							self.sharedSteps(rule, shared))
+			finally:
+				self.maxDepth = resolveMaxDepth
+		logger.debug("compiled " + str(len(self.ruleList)) + " rules, " + 
+			str(len(shared)) + " shared with base")
+
+	def sharedRules(self):
+		"""Returns the set of rules whose plans can be taken from the base 
+			engine: those compiled there, which can only recurse (according to
+			the RuleGraph) into other such rules, and so resolve every value
+			identically.
+		"""
+		if (self.base == None or self.base.inline != self.inline or 
+				self.base.renderDelimiters != self.renderDelimiters):
+			return set()
+		unshared = set([rule for rule in self.ruleList.rules 
+			if rule not in self.base.plans])
+		changed = True
+		while changed:
+			changed = False
+			for rule in self.ruleList.rules:
+				if rule in unshared:
+					continue
+				for successor in self.ruleGraph.edges[rule]:
+					if successor in unshared:
+						unshared.add(rule)
+						changed = True
+						break
+		return set([rule for rule in self.ruleList.rules if rule not in unshared])
+
+	def sharedSteps(self, rule, shared):
+		"""Returns the steps of the base engine's plan for 'rule' which can be
+			reused, by index: recursive tokens whose every candidate rule (see
+			RuleGraph.candidates) is in 'shared'.
+		"""
+		if self.base == None or rule not in self.base.plans:
+			return {}
+		states = iter(self.ruleGraph.successors(rule, "?" * len(rule.lhs)))
+		steps = {}
+		for i, step in enumerate(self.base.plans[rule]):
+			if step[0] == tokenLiteral:
+				continue
+			candidates = self.ruleGraph.candidates(next(states))
+			if len([c for c in candidates if c not in shared]) == 0:
+				steps[i] = step
+		return steps
+
+	def compileRendering(self):
+		"""Maps each rhs delimiter to the string it renders as, according to
+			the rule list's directives.
+		"""
+		self.renderDelimiters = {
+			",": self.ruleList.directives["separator"],
+			"+": self.ruleList.directives["joiner"]}
+
+	def buildPlan(self, rule):
+		plan = []
+		for rhsToken in rule.rhsTokenList:
+			if rhsToken[0:1] == '(' and rhsToken[-1:] == ')':
+				plan.append((tokenRecurse, compileTemplate(rhsToken[1:-1]), None))
+			else:
+				plan.append((tokenLiteral, compileTemplate(rhsToken), None))
+		return plan
+
+	def inlinePlan(self, rule, plan, sharedSteps={}):
+		inlinedPlan = []
+		for i, (kind, template, data) in enumerate(plan):
+			if i in sharedSteps:
+				inlinedPlan.append(sharedSteps[i])
+				continue
+			if kind == tokenRecurse and template.__class__ is str:
+				data = self.evaluateFragment(template)
+				if data != None:
+					kind = tokenFixed
+			elif kind == tokenRecurse:
+				groups = sorted(set([x for x in template if x.__class__ is int]))
+				if len(groups) <= inlineMaxDigivars:
+					data = {}
+					for digits in itertools.product("0123456789", repeat=len(groups)):
+						values = dict(zip(groups, digits))
+						fragment = "".join([values[x] if x.__class__ is int else x 
+							for x in template])
+						result = self.evaluateFragment(fragment)
+						if result != None:
+							data[fragment] = result
+					kind = tokenTable
+			inlinedPlan.append((kind, template, data))
+		return inlinedPlan
+
+	def evaluateFragment(self, fragment):
+		"""Returns (tokens, rendered string) for a fragment, or None if it cannot
+			be resolved (that is left to fail at runtime, as it would without
+			inlining).  Results are kept in 'fragments', and taken from the 
+			base engine's where the fragment can only match shared rules.
+		"""
+		if fragment in self.fragments:
+			return self.fragments[fragment]
+		if self.base != None and fragment in self.base.fragments:
+			candidates = self.ruleGraph.candidates(fragment)
+			if len([c for c in candidates if c not in self.shared]) == 0:
+				self.fragments[fragment] = self.base.fragments[fragment]
+				return self.fragments[fragment]
+		self.fragments[fragment] = self.resolveFragment(fragment)
+		return self.fragments[fragment]
+
+	def resolveFragment(self, fragment):
+		tokens = []
+		parts = []
+		try:
+			if not self.resolveInto(fragment, tokens, parts):
+				return None
+		except (RuleEvaluationException, RuntimeError):
+			return None
+		return (tokens, "".join(parts))
+
+	def exportTable(self):
+		"""Returns the rule list as a portable decision table (a JSON-ready
+			dict), for evaluation by other runtimes such as site/naturalnum.js.
+			Rules are listed in search order.  Each token is a template of
+			literal strings and 0-based indexes of the digits bound to the
+			rule's digivars (in lhs order), flagged if it is to be recursed.
+		"""
+		rules = []
+		for rule in self.ruleList.rules:
+			tokens = []
+			for kind, template, data in self.buildPlan(rule):
+				if template.__class__ is str:
+					template = [template]
+				tokens.append({"recurse": kind == tokenRecurse, "template": list(template)})
+			rules.append({"lhs": rule.lhs, "tokens": tokens, 
+				"delimiters": rule.rhsDelimiterList})
+		return {"format": "naturalnum-rules", 
+			"version": exportFormatVersion,
+			"contentHash": self.ruleList.contentHash(),
+			"separator": self.ruleList.directives["separator"],
+			"joiner": self.ruleList.directives["joiner"],
+			"rules": rules}
+
+	def preload(self, values, maxBytes=None, background=False):
+		"""Resolves 'values' (e.g. the most frequent first, from a warm set -
+			see readWarmSet) in advance, so resolve() and render() serve them 
+			from memory.  Stops once the estimated size of preloaded results 
+			exceeds 'maxBytes', if given.  With 'background', preloading runs
+			in a daemon thread, which is returned.
+		"""
+		if background:
+			thread = threading.Thread(target=self.preload, args=(values, maxBytes))
+			thread.daemon = True
+			thread.start()
+			return thread
+		for value in values:
+			if value in self.preloaded:
+				continue
+			tokens = []
+			parts = []
+			try:
+				if not self.resolveInto(value, tokens, parts):
+					continue
+			except (RuleEvaluationException, RuntimeError):
+				continue
+			result = (tokens, "".join(parts))
+			size = (sys.getsizeof(value) + sys.getsizeof(tokens) + 
+				sys.getsizeof(result[1]) + sum([sys.getsizeof(t) for t in tokens]))
+			if maxBytes != None and self.preloadedBytes + size > maxBytes:
+				break
+			self.preloaded[value] = result
+			self.preloadedBytes = self.preloadedBytes + size
+		logger.debug("preloaded " + str(len(self.preloaded)) + " values, " + 
+			str(self.preloadedBytes) + " bytes")
+		return None
+
+	def attachCache(self, cache, locale):
+		"""Serves resolve() and render() results from a persistent cache (e.g.
+			SqliteResolutionCache), storing results on a miss.  Entries are
+			keyed by 'locale' and the content hash of the rule list, and
+			entries for older versions of this locale's rules are purged (see
+			SqliteResolutionCache.purge).  The rule list must not be modified
+			while a cache is attached.
+		"""
+		self.cache = cache
+		self.cacheLocale = locale
+		self.cacheRuleHash = self.ruleList.contentHash()
+		cache.purge(locale, self.cacheRuleHash)
 
 	@classmethod
-	def fromLangFilename(cls, fileName):
+	def fromLangFilename(cls, fileName, inline=True, cache=None):
+		"""Loads a RuleEngine from a .lang file.  If the file declares a base
+			locale (e.g. @base=fr_FR), the base is loaded from the same 
+			directory (see LangLoader).
+		"""
 		logger.debug("fromLangFilename()")
-		f = open(fileName, 'r')
-		logger.debug("opened config file [" + fileName + "]")
-		ruleList = RuleList()
-		for line in f:
-			logger.debug("read line: [" + line[0:-1] + "]")
-			rule = validateAndParseRule(line)
-			if rule != None:
-				logger.debug("Adding Rule to RuleList")
-				ruleList.add(rule)
-			else:
-				logger.debug("No rule found, skipping this line")
-		re = RuleEngine(ruleList)
+		loader = LangLoader(os.path.dirname(fileName), inline, cache)
+		re = loader.load(os.path.splitext(os.path.basename(fileName))[0], fileName)
 		logger.debug("finished loading RuleEngine")
 		return re
 
+	def aggregate(self, start, stop):
+		"""Returns a RangeAggregate of totals over resolving every value in 
+			range(start, stop), computed from the structure of the rules (see 
+			RangeAggregator) rather than by resolving each value.  Raises 
+			RuleEvaluationException if some value in the range would fail to 
+			resolve, other than by matching no rule.
+		"""
+		if self.aggregator == None:
+			self.aggregator = RangeAggregator(self)
+		return self.aggregator.aggregate(start, stop)
+
+	def setBudget(self, budget):
+		"""Limits the work done by each resolve()/render() call, according to a
+			ResolutionBudget (None for no limits).  With a budget set, values 
+			which are not digits-only are rejected with RuleUsageException 
+			before any rule is scanned, and exceeding any limit raises 
+			RuleBudgetException.  Both are counted (inputsRejected and 
+			budgetsExceeded).
+		"""
+		self.budget = budget
+
+	def checkValue(self, value):
+		"""Applies the budget's checks on an input value, returning a new 
+			BudgetTracker for resolving it, or None if there is no budget.
+		"""
+		if self.budget == None:
+			return None
+		if valueValidatorPattern.match(value) == None:
+			self.inputsRejected = self.inputsRejected + 1
+			raise RuleUsageException("Could not resolve [" + value[0:32] + 
+				"]: only digits are allowed")
+		tracker = BudgetTracker(self.budget)
+		try:
+			tracker.checkLength(value)
+		except RuleBudgetException:
+			self.budgetsExceeded = self.budgetsExceeded + 1
+			raise
+		return tracker
+
+	def resolveWithin(self, value, tokens, parts, tracker):
+		"""resolveInto() for a top-level value, within the budget (if any)."""
+		if len(value) not in self.lhsLengths:
+			return False
+		if tracker == None:
+			return self.resolveInto(value, tokens, parts)
+		try:
+			return self.resolveInto(value, tokens, parts, 0, tracker)
+		except RuleBudgetException:
+			self.budgetsExceeded = self.budgetsExceeded + 1
+			raise
+
 	def resolve(self, value):
 		logger.debug("resolve() value=[" + value + "]")
-		matchedRule = self.ruleList.search(value)
-		if not matchedRule == None:
-			logger.debug("found matched rule: " + str(matchedRule))
-			rhsTokens = matchedRule.resolve(value)
-			rhsTokensFollowingRecursion = []
-			for rhsToken in rhsTokens:
-				## If current rhs token is enclosed in brackets, replace it with
-				## the result of feeding the value (without brackets) back through
-				## the rule engine.
-				if rhsToken[0:1] == '(' and rhsToken[-1:] == ')':
-					rhsTokenToRecurse = rhsToken[1:-1]
-					logger.debug("Recursing value [" + rhsTokenToRecurse + "] back through rule engine")
-					resultAfterRecursion = self.resolve(rhsTokenToRecurse)
-					if resultAfterRecursion == None:
-						raise RuleEvaluationException("Could not match fragment of result [" + \
-							rhsTokenToRecurse + "] to a rule")	
-					rhsTokensFollowingRecursion = rhsTokensFollowingRecursion + \
-						resultAfterRecursion
-				else:
-					rhsTokensFollowingRecursion.append(rhsToken)					
-			return rhsTokensFollowingRecursion
-		else:
+		tracker = self.checkValue(value)
+		preloaded = self.preloaded.get(value)
+		if preloaded != None:
+			return list(preloaded[0])
+		if self.cache != None:
+			cached = self.cache.get(self.cacheLocale, self.cacheRuleHash, "resolve", value)
+			if cached != None:
+				return cached
+		tokens = []
+		if not self.resolveWithin(value, tokens, None, tracker):
 			logger.debug("could not find matching rule")
 			return None
+		if self.cache != None:
+			self.cache.put(self.cacheLocale, self.cacheRuleHash, "resolve", value, tokens)
+		return tokens
+
+	def render(self, value):
+		"""Resolves 'value' straight to its final string, joining tokens with
+			the locale's separator (',' in rules) or joiner ('+' in rules).
+			Output fragments are accumulated in a single pass, without building
+			a token list per recursion level.  Returns None if no rule matches.
+		"""
+		tracker = self.checkValue(value)
+		preloaded = self.preloaded.get(value)
+		if preloaded != None:
+			return preloaded[1]
+		if self.cache != None:
+			cached = self.cache.get(self.cacheLocale, self.cacheRuleHash, "render", value)
+			if cached != None:
+				return cached
+		parts = []
+		if not self.resolveWithin(value, None, parts, tracker):
+			return None
+		rendered = "".join(parts)
+		if self.cache != None:
+			self.cache.put(self.cacheLocale, self.cacheRuleHash, "render", value, rendered)
+		return rendered
+
+	def aresolve(self, value):
+		"""Awaitable version of resolve(), for use with asyncio.  Requests are
+			coalesced and batched onto an executor; see setAsyncOptions().
+		"""
+		return self.asyncFrontEnd().resolve(value)
+
+	def arender(self, value):
+		"""Awaitable version of render(); see aresolve()."""
+		return self.asyncFrontEnd().render(value)
+
+	def setAsyncOptions(self, **options):
+		"""Configures aresolve()/arender() with AsyncResolver options 
+			(maxBatchSize, maxDelay, maxPending, executor).
+		"""
+		from naturalnum_async import AsyncResolver
+		self.asyncResolver = AsyncResolver(self, **options)
+
+	def asyncFrontEnd(self):
+		if self.asyncResolver == None:
+			self.setAsyncOptions()
+		return self.asyncResolver
+
+	def resolveInto(self, value, tokens, parts, depth=0, tracker=None):
+		"""Resolves 'value', appending its tokens to the list 'tokens' and its
+			rendered fragments to the list 'parts' (either may be None).  
+			Returns False if no rule matches 'value'.  Each step is charged to
+			'tracker', if given.
+		"""
+		if self.maxDepth != None and depth > self.maxDepth:
+			raise RuleEvaluationException("Recursion deeper than " + 
+				str(self.maxDepth) + " resolving [" + value + "]")
+		index = self.ruleIndex.first(value)
+		if tracker != None:
+			tracker.step(value)
+			tracker.scanned(len(self.ruleList) if index == -1 else index + 1)
+		matchedRule = None if index == -1 else self.ruleList.rules[index]
+		if matchedRule == None:
+			return False
+		plan = self.plans.get(matchedRule)
+		if plan == None:
+			plan = self.plans[matchedRule] = self.buildPlan(matchedRule)
+		groups = matchedRule.lhsRegexPattern.match(value).groups()
+		delimiters = matchedRule.rhsDelimiterList
+		for i, (kind, template, data) in enumerate(plan):
+			if parts is not None and i > 0:
+				parts.append(self.renderDelimiters[delimiters[i - 1]])
+			if kind == tokenLiteral:
+				rhsToken = expandTemplate(template, groups)
+				if tokens is not None:
+					tokens.append(rhsToken)
+				if parts is not None:
+					parts.append(rhsToken)
+				continue
+			if kind == tokenFixed:
+				result = data
+			else:
+				## Feed the value of a recursive token back through the rule 
+				## engine, unless its result was already tabled by compile().
+				rhsTokenToRecurse = expandTemplate(template, groups)
+				result = None
+				if kind == tokenTable:
+					result = data.get(rhsTokenToRecurse)
+				if result == None:
+					if not self.resolveInto(rhsTokenToRecurse, tokens, parts, depth + 1, tracker):
+						raise RuleEvaluationException("Could not match fragment of result [" + \
+							rhsTokenToRecurse + "] to a rule")
+					continue
+			if tokens is not None:
+				tokens.extend(result[0])
+			if parts is not None:
+				parts.append(result[1])
+		return True
+
+	def resolveBuffer(self, buf, out, separator=",", encoding="utf-8"):
+		"""Resolves every newline-separated value in a bytes-like buffer
+			(bytes, bytearray, memoryview or mmap), writing one line of
+			'separator'-joined tokens per value to 'out'.
+
+			Lines are located and validated in place, without decoding the
+			whole buffer.  Blank lines (including a lone CR) are skipped.  A 
+			line which is not digits-only, which no rule matches, or which 
+			fails to resolve is reported in the returned BulkResult (by byte 
+			offset into 'buf') and an empty line is written in its place, so 
+			output lines stay aligned with input values.  Results for the 
+			bulkMemoSize most recently used values are kept, for repeats.
+
+			'out' is either a file-like object with a write() method, or a
+			pre-sized writable buffer (bytearray, writable memoryview or mmap)
+			which is filled from offset 0.  RuleUsageException is raised if a
+			buffer is too small to hold the output.
+		"""
+		result = BulkResult()
+		writeToBuffer = not hasattr(out, "write")
+		sep = separator.encode(encoding)
+		resolved = collections.OrderedDict()
+		pos = 0
+		for match in bulkLinePattern.finditer(buf):
+			start = match.start()
+			end = match.end()
+			if end - start == 1 and bytes(buf[start:end]) == b"\r":
+				continue
+			if bulkDigitsPattern.match(buf, start, end) == None:
+				result.addError(start, "not a digits-only value")
+				data = b"\n"
+			else:
+				value = bytes(buf[start:end]).rstrip(b"\r")
+				data = resolved.pop(value, None)
+				if data == None:
+					try:
+						tokens = self.resolve(value.decode("ascii"))
+						error = None if tokens != None else "no rule matches value"
+					except RuleEvaluationException as e:
+						error = str(e.value)
+					except RuntimeError as e:
+						error = "could not resolve value: " + str(e)
+					if error != None:
+						result.addError(start, error)
+						data = b"\n"
+					else:
+						data = sep.join([t.encode(encoding) for t in tokens]) + b"\n"
+				if data != b"\n":
+					resolved[value] = data
+					if len(resolved) > bulkMemoSize:
+						resolved.popitem(False)
+			if writeToBuffer:
+				if pos + len(data) > len(out):
+					raise RuleUsageException("Output buffer too small: " +
+						str(len(out)) + " bytes available, input offset " +
+						str(start))
+				out[pos:pos + len(data)] = data
+			else:
+				out.write(data)
+			pos = pos + len(data)
+			result.count = result.count + 1
+		result.bytesWritten = pos
+		return result
+
+	def resolveFile(self, inFileName, outFileName, separator=",", encoding="utf-8"):
+		"""Resolves a newline-separated file of values via resolveBuffer(),
+			memory-mapping the input rather than reading it line by line.
+		"""
+		f = open(inFileName, 'rb')
+		try:
+			out = open(outFileName, 'wb')
+			try:
+				if os.fstat(f.fileno()).st_size == 0:
+					return BulkResult()
+				buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+				try:
+					return self.resolveBuffer(buf, out, separator, encoding)
+				finally:
+					buf.close()
+			finally:
+				out.close()
+		finally:
+			f.close()
+
+class RuleGraph:
+	"""Load-time analysis of recursion between the rules in a RuleList.
+
+		Each recursive rhs token is described by an abstract value, in which 
+		every digit bound from a digivar is replaced by '?', e.g. for
+		T00u=($T000),($u) the tokens are "?000" and "?".  'edges' maps each rule
+		to the rules its recursive tokens may match.
+
+		Where the first rule which may match an abstract value matches every
+		value it stands for, the step is definite.  A cycle of definite steps
+		(e.g. tu=($t$u)) can never terminate, and is reported in 'errors' as a
+		(rule, message) tuple, as is a recursive token which no rule can match.
+
+		For a rule list which inherits from another (see RuleList.inherit), 
+		'base' may be the graph of the base list, if it has no errors.  Its
+		index is then shared (see OverlayIndex), and base rules whose 
+		recursion no added or overriding rule can affect are not checked 
+		again.
+	"""
+
+	def __init__(self, ruleList, base=None):
+		self.ruleList = ruleList
+		self.base = None
+		self.changed = None       ## RuleIndex of added and overriding rules
+		self.candidateLists = {}
+		self.edges = {}
+		self.errors = []
+		if base != None:
+			self.inherit(base)
+		if self.base == None:
+			self.index = RuleIndex(ruleList.rules)
+		unaffected = self.unaffectedRules()
+		checked = set()
+		for rule in ruleList.rules:
+			if rule in unaffected:
+				self.edges[rule] = self.base.edges[rule]
+				continue
+			self.edges[rule] = []
+			reported = False
+			for state in self.successors(rule, "?" * len(rule.lhs)):
+				candidates = self.candidates(state)
+				if len(candidates) == 0:
+					self.errors.append((rule, "Recursive token in rule [" + 
+						rule.lhs + "=" + rule.rhs + "] cannot match any rule"))
+					reported = True
+					continue
+				for candidate in candidates:
+					if candidate not in self.edges[rule]:
+						self.edges[rule].append(candidate)
+				cycle = self.findCycle(state, [], checked)
+				if cycle != None:
+					self.errors.append((rule, "Recursion in rule [" + rule.lhs + 
+						"=" + rule.rhs + "] does not terminate: " + 
+						" -> ".join(cycle)))
+					reported = True
+			if reported:
+				continue
+			for rhsToken in rhsDelimiterPattern.split(rule.rhs)[0::2]:
+				if rhsToken[0:1] != '(' or rhsToken[-1:] != ')':
+					continue
+				value = self.identityValue(rule, rhsToken[1:-1])
+				if value != None:
+					self.errors.append((rule, "Recursion in rule [" + rule.lhs + 
+						"=" + rule.rhs + "] does not terminate for value [" + 
+						value + "]"))
+					break
+
+	def inherit(self, base):
+		"""Shares the index of 'base', the graph of the list this graph's rule
+			list inherits from, if the rules are still in the order inherit()
+			left them: each base rule, or the rule overriding it, in its place.
+		"""
+		baseRules = base.ruleList.rules
+		baseLhs = set([rule.lhs for rule in baseRules])
+		baseSlots = []
+		added = []
+		addedSlots = []
+		changed = []
+		for i, rule in enumerate(self.ruleList.rules):
+			j = len(baseSlots)
+			if j < len(baseRules) and rule.lhs == baseRules[j].lhs:
+				baseSlots.append(i)
+				if rule is not baseRules[j]:
+					changed.append(rule)
+			elif rule.lhs in baseLhs:
+				return
+			else:
+				added.append(rule)
+				addedSlots.append(i)
+				changed.append(rule)
+		if len(baseSlots) != len(baseRules):
+			return
+		self.base = base
+		self.index = OverlayIndex(base.index, baseSlots, added, addedSlots)
+		self.changed = RuleIndex(changed)
+
+	def unaffectedRules(self):
+		"""Returns the set of base rules (see inherit) whose recursive tokens 
+			no added or overriding rule may match, nor those of any rule they 
+			may recurse into.  They recurse exactly as in the base graph.
+		"""
+		if self.base == None:
+			return set()
+		unaffected = set()
+		recursive = []
+		for rule in self.ruleList.rules:
+			if rule not in self.base.edges:
+				continue
+			if len(self.base.edges[rule]) == 0:
+				unaffected.add(rule)    ## No recursive tokens
+				continue
+			states = self.successors(rule, "?" * len(rule.lhs))
+			if len([s for s in states if self.changed.matching(s)]) == 0:
+				unaffected.add(rule)
+				recursive.append(rule)
+		changed = True
+		while changed:
+			changed = False
+			for rule in recursive:
+				if rule not in unaffected:
+					continue
+				for successor in self.base.edges[rule]:
+					if successor not in unaffected:
+						unaffected.discard(rule)
+						changed = True
+						break
+		return unaffected
+
+	def candidates(self, state):
+		"""Returns the rules, in order, which may match some value represented by
+			'state'.  The list ends at the first rule matching all of them.
+		"""
+		candidates = self.candidateLists.get(state)
+		if candidates != None:
+			return candidates
+		if self.base != None and not self.changed.matching(state):
+			candidates = self.candidateLists[state] = self.base.candidates(state)
+			return candidates
+		candidates = []
+		for i in self.index.matching(state):
+			rule = self.ruleList.rules[i]
+			candidates.append(rule)
+			covers = True
+			for l, s in zip(rule.lhs, state):
+				if l.isdigit() and s == '?':
+					covers = False
+					break
+			if covers:
+				break
+		self.candidateLists[state] = candidates
+		return candidates
+
+	def identityValue(self, rule, token):
+		"""Returns a value which 'rule' matches first, and for which the 
+			recursive 'token' (e.g. '$t0', without brackets) is the value 
+			itself, so that resolving it never terminates; or None.  For
+			example, for tu=($t0),($u) the value 00 maps to itself.  Tokens 
+			leaving more than identityMaxDigivars digits free are not checked.
+		"""
+		terms = re.findall(r"\$[A-Za-z]|[0-9]", token)
+		if len(terms) != len(rule.lhs):
+			return None
+		## Unify each lhs position with the same position of the token: digits
+		## must be equal, and a digivar takes the value of its counterpart
+		parent = {}
+		def find(term):
+			while parent.get(term, term) != term:
+				term = parent[term]
+			return term
+		for l, t in zip(rule.lhs, terms):
+			a = find(l if l.isdigit() else "$" + l)
+			b = find(t)
+			if a == b:
+				continue
+			if a.isdigit() and b.isdigit():
+				return None
+			if a.isdigit():
+				a, b = b, a
+			parent[a] = b
+		digivars = ["$" + l for l in rule.lhs if not l.isdigit()]
+		free = sorted(set([find(v) for v in digivars if not find(v).isdigit()]))
+		if len(free) > identityMaxDigivars:
+			return None
+		for digits in itertools.product("0123456789", repeat=len(free)):
+			values = dict(zip(free, digits))
+			value = "".join([l if l.isdigit() else values.get(find("$" + l), find("$" + l))
+				for l in rule.lhs])
+			if self.candidates(value)[0:1] == [rule]:
+				return value
+		return None
+
+	def isDefinite(self, state, candidates):
+		"""True if the only candidate rule matches every value of 'state'."""
+		if len(candidates) != 1:
+			return False
+		for l, s in zip(candidates[0].lhs, state):
+			if l.isdigit() and s == '?':
+				return False
+		return True
+
+	def successors(self, rule, state):
+		"""Returns the abstract values of the recursive tokens of 'rule', when
+			it matches a value represented by 'state'.
+		"""
+		refined = "".join([l if l.isdigit() else s for l, s in zip(rule.lhs, state)])
+		successors = []
+		for rhsToken in rhsDelimiterPattern.split(rule.rhs)[0::2]:
+			if rhsToken[0:1] != '(' or rhsToken[-1:] != ')':
+				continue
+			successor = rhsPlaceholderPattern.sub(
+				lambda m: refined[rule.lhs.index(m.group(0)[1])], rhsToken[1:-1])
+			successors.append(successor)
+		return successors
+
+	def findCycle(self, state, path, checked):
+		"""Follows definite steps from 'state', returning the list of rules
+			(by lhs) forming a cycle, or None.  States in 'checked' are known 
+			not to lead to a cycle.
+		"""
+		if state in checked:
+			return None
+		for i in range(len(path)):
+			if path[i][0] == state:
+				return [lhs for s, lhs in path[i:]] + [path[i][1]]
+		candidates = self.candidates(state)
+		if self.isDefinite(state, candidates):
+			rule = candidates[0]
+			path.append((state, rule.lhs))
+			for successor in self.successors(rule, state):
+				cycle = self.findCycle(successor, path, checked)
+				if cycle != None:
+					return cycle
+			path.pop()
+		checked.add(state)
+		return None
+
+class RuleIndex:
+	"""Finds the rules which may match a value without testing every rule.
+		Rules are held in a trie by lhs, in which every digivar is the same 
+		'?' branch.
+	"""
+
+	def __init__(self, rules):
+		self.root = {}
+		for i, rule in enumerate(rules):
+			node = self.root
+			for c in rule.lhs:
+				node = node.setdefault(c if c.isdigit() else '?', {})
+			node.setdefault(None, []).append(i)
+
+	def matching(self, state):
+		"""Returns the indexes, in search order, of the rules which may match 
+			some value represented by 'state' (see RuleGraph), in which '?' 
+			stands for any digit.
+		"""
+		found = []
+		self.collect(self.root, state, 0, True, found)
+		found.sort()
+		return found
+
+	def first(self, value):
+		"""Returns the index of the first rule matching 'value', or -1."""
+		found = []
+		self.collect(self.root, value, 0, False, found)
+		if not found:
+			return -1
+		return min(found)
+
+	def collect(self, node, state, pos, wildcards, found):
+		if pos == len(state):
+			found.extend(node.get(None, ()))
+			return
+		c = state[pos]
+		if wildcards and c == '?':
+			for key, child in node.items():
+				if key != None:
+					self.collect(child, state, pos + 1, wildcards, found)
+			return
+		child = node.get(c)
+		if child != None and c != '?':
+			self.collect(child, state, pos + 1, wildcards, found)
+		## A digivar matches any character but a newline, as in lhsRegex
+		child = node.get('?')
+		if child != None and c != '\n':
+			self.collect(child, state, pos + 1, wildcards, found)
+
+class OverlayIndex:
+	"""A RuleIndex for a rule list which inherits from another (see 
+		RuleList.inherit), sharing the base list's index.  Only the added 
+		rules are indexed again: a rule overriding a base rule has the same 
+		lhs, so matches in its place.  'baseSlots' and 'addedSlots' give the 
+		index in the inheriting list of each base rule and added rule.
+	"""
+
+	def __init__(self, baseIndex, baseSlots, added, addedSlots):
+		self.baseIndex = baseIndex
+		self.baseSlots = baseSlots
+		self.addedIndex = RuleIndex(added)
+		self.addedSlots = addedSlots
+
+	def matching(self, state):
+		"""Returns the indexes, in search order, of the rules which may match
+			some value represented by 'state' (see RuleIndex.matching).
+		"""
+		found = [self.baseSlots[i] for i in self.baseIndex.matching(state)]
+		found.extend([self.addedSlots[i] for i in self.addedIndex.matching(state)])
+		found.sort()
+		return found
+
+	def first(self, value):
+		"""Returns the index of the first rule matching 'value', or -1."""
+		i = self.baseIndex.first(value)
+		j = self.addedIndex.first(value)
+		if j == -1:
+			return -1 if i == -1 else self.baseSlots[i]
+		if i == -1:
+			return self.addedSlots[j]
+		return min(self.baseSlots[i], self.addedSlots[j])
+
+class ResolverSession:
+	"""Resolves a value which changes a digit at a time (e.g. as it is typed on
+		a keypad), re-resolving only what the change affects.
+
+		The resolution of each recursive fragment of the current value is 
+		kept.  When the value changes, fragments whose digits are unchanged 
+		(e.g. the thousands in 12345 when the units change) are reused rather
+		than resolved again, and only fragments of the new value are then kept
+		(those of the last value resolved are kept while no rule matches, 
+		e.g. until a digit too many is deleted again).  The engine's budget,
+		if any, applies to each value (see RuleEngine.setBudget).
+	"""
+
+	def __init__(self, engine):
+		self.engine = engine
+		self.value = ""
+		self.result = None
+		self.fragments = {}
+		self.reused = 0
+		self.resolved = 0
+
+	def setValue(self, value):
+		"""Changes the current value, returning its tokens (None if no rule 
+			matches it).
+		"""
+		fragments = {}
+		result = None
+		if value != "":
+			engine = self.engine
+			tracker = engine.checkValue(value)
+			if len(value) in engine.lhsLengths:
+				try:
+					result = self.resolveFragment(value, fragments, 0, tracker)
+				except RuleBudgetException:
+					engine.budgetsExceeded = engine.budgetsExceeded + 1
+					raise
+		self.value = value
+		self.result = result
+		if result != None:
+			self.fragments = fragments
+		return self.tokens()
+
+	def append(self, digit):
+		return self.setValue(self.value + digit)
+
+	def backspace(self):
+		return self.setValue(self.value[:-1])
+
+	def replace(self, pos, digit):
+		return self.setValue(self.value[:pos] + digit + self.value[pos + 1:])
+
+	def tokens(self):
+		if self.result == None:
+			return None
+		return list(self.result[0])
+
+	def render(self):
+		if self.result == None:
+			return None
+		return self.result[1]
+
+	def resolveFragment(self, value, fragments, depth=0, tracker=None):
+		"""Returns (tokens, rendered string) for 'value', or None if no rule 
+			matches it, recording the result of every fragment in 'fragments'.
+			Each fragment resolved is charged to 'tracker', if given.
+		"""
+		result = self.fragments.get(value)
+		if result != None:
+			self.reused = self.reused + 1
+			self.keepFragment(value, fragments)
+			return result
+		engine = self.engine
+		if engine.maxDepth != None and depth > engine.maxDepth:
+			raise RuleEvaluationException("Recursion deeper than " + 
+				str(engine.maxDepth) + " resolving [" + value + "]")
+		index = engine.ruleIndex.first(value)
+		if tracker != None:
+			tracker.step(value)
+			tracker.scanned(len(engine.ruleList) if index == -1 else index + 1)
+		if index == -1:
+			return None
+		matchedRule = engine.ruleList.rules[index]
+		self.resolved = self.resolved + 1
+		plan = engine.plans.get(matchedRule)
+		if plan == None:
+			plan = engine.plans[matchedRule] = engine.buildPlan(matchedRule)
+		groups = matchedRule.lhsRegexPattern.match(value).groups()
+		delimiters = matchedRule.rhsDelimiterList
+		tokens = []
+		parts = []
+		children = []
+		for i, (kind, template, data) in enumerate(plan):
+			if i > 0:
+				parts.append(engine.renderDelimiters[delimiters[i - 1]])
+			if kind == tokenLiteral:
+				rhsToken = expandTemplate(template, groups)
+				tokens.append(rhsToken)
+				parts.append(rhsToken)
+				continue
+			if kind == tokenFixed:
+				fragmentResult = data
+			else:
+				rhsTokenToRecurse = expandTemplate(template, groups)
+				fragmentResult = None
+				if kind == tokenTable:
+					fragmentResult = data.get(rhsTokenToRecurse)
+				if fragmentResult == None:
+					fragmentResult = self.resolveFragment(rhsTokenToRecurse, fragments, 
+						depth + 1, tracker)
+					children.append(rhsTokenToRecurse)
+				if fragmentResult == None:
+					raise RuleEvaluationException("Could not match fragment of result [" + \
+						rhsTokenToRecurse + "] to a rule")
+			tokens.extend(fragmentResult[0])
+			parts.append(fragmentResult[1])
+		result = (tokens, "".join(parts), children)
+		fragments[value] = result
+		return result
+
+	def keepFragment(self, value, fragments):
+		"""Copies a fragment of the previous value, and the fragments it was
+			built from, into 'fragments'.
+		"""
+		result = self.fragments[value]
+		fragments[value] = result
+		for child in result[2]:
+			if child not in fragments:
+				self.keepFragment(child, fragments)
+
+class SqliteResolutionCache:
+	"""Persistent cache of resolve()/render() results in a SQLite database 
+		file, which may be shared by any number of processes.  The database is
+		opened in WAL mode, so readers do not block on writers, and writers
+		wait up to 'timeout' seconds for each other.  See 
+		RuleEngine.attachCache().
+
+		The 'memorySize' results most recently used in this process are also
+		kept in memory, and served without a query.  Entries are keyed by the
+		content hash of the rules, so never go out of date.  Entries for old
+		versions of a locale's rules are deleted as set out in purge().
+	"""
+
+	def __init__(self, fileName, timeout=30.0, memorySize=cacheMemorySize,
+			keepVersions=cacheKeepVersions, maxAge=None):
+		import sqlite3
+		self.fileName = fileName
+		self.memorySize = memorySize
+		self.keepVersions = keepVersions
+		self.maxAge = maxAge
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(fileName, timeout=timeout,
+			isolation_level=None, check_same_thread=False)
+		self.connection.execute("PRAGMA journal_mode=WAL")
+		self.connection.execute("PRAGMA synchronous=NORMAL")
+		self.connection.execute("CREATE TABLE IF NOT EXISTS resolution ("
+			"locale TEXT, ruleHash TEXT, method TEXT, value TEXT, result TEXT, "
+			"PRIMARY KEY (locale, ruleHash, method, value))")
+		self.connection.execute("CREATE TABLE IF NOT EXISTS ruleVersion ("
+			"locale TEXT, ruleHash TEXT, lastUsed REAL, "
+			"PRIMARY KEY (locale, ruleHash))")
+		self.memory = collections.OrderedDict()
+		self.hits = 0
+		self.memoryHits = 0
+		self.misses = 0
+
+	def get(self, locale, ruleHash, method, value):
+		"""Returns the cached result, or None."""
+		key = (locale, ruleHash, method, value)
+		with self.lock:
+			result = self.memory.pop(key, None)
+			if result != None:
+				self.memoryHits = self.memoryHits + 1
+			else:
+				row = self.connection.execute("SELECT result FROM resolution WHERE "
+					"locale=? AND ruleHash=? AND method=? AND value=?",
+					key).fetchone()
+				if row == None:
+					self.misses = self.misses + 1
+					return None
+				result = json.loads(row[0])
+			self.hits = self.hits + 1
+			self.remember(key, result)
+		if result.__class__ is list:
+			return list(result)
+		return result
+
+	def put(self, locale, ruleHash, method, value, result):
+		key = (locale, ruleHash, method, value)
+		with self.lock:
+			self.connection.execute("INSERT OR REPLACE INTO resolution "
+				"VALUES (?, ?, ?, ?, ?)", key + (json.dumps(result),))
+			self.remember(key, list(result) if result.__class__ is list else result)
+
+	def remember(self, key, result):
+		"""Keeps 'result' in memory, forgetting the least recently used."""
+		self.memory[key] = result
+		if len(self.memory) > self.memorySize:
+			self.memory.popitem(False)
+
+	def purge(self, locale, ruleHash):
+		"""Records that rule set 'ruleHash' of 'locale' is in use, and deletes
+			entries for the locale's other rule sets, except for the 
+			'keepVersions' most recently in use which were in use in the last
+			'maxAge' seconds (if given).  So processes with different versions
+			of the rules (e.g. during a rolling deploy) keep each other's 
+			entries.
+		"""
+		now = time.time()
+		with self.lock:
+			self.connection.execute("BEGIN IMMEDIATE")
+			try:
+				self.connection.execute("INSERT OR REPLACE INTO ruleVersion "
+					"VALUES (?, ?, ?)", (locale, ruleHash, now))
+				rows = self.connection.execute("SELECT ruleHash, lastUsed FROM "
+					"ruleVersion WHERE locale=? ORDER BY lastUsed DESC, rowid DESC",
+					(locale,)).fetchall()
+				kept = [version for version, lastUsed in rows[0:max(self.keepVersions, 1)]
+					if version == ruleHash or self.maxAge == None or 
+						now - lastUsed <= self.maxAge]
+				others = " AND ruleHash NOT IN (" + ",".join(["?"] * len(kept)) + ")"
+				self.connection.execute("DELETE FROM ruleVersion WHERE locale=?" + 
+					others, [locale] + kept)
+				self.connection.execute("DELETE FROM resolution WHERE locale=?" + 
+					others, [locale] + kept)
+				self.connection.execute("COMMIT")
+			except Exception:
+				self.connection.execute("ROLLBACK")
+				raise
+
+	def close(self):
+		with self.lock:
+			self.connection.close()
+
+class ResolutionBudget:
+	"""Limits on the work done resolving one value (see RuleEngine.setBudget).
+		Any limit may be None for no limit.
+		- maxInputLength: maximum number of digits in the value
+		- maxRulesScanned: maximum rules searched, in search order, up to the
+		  match for each value and fragment, in total
+		- maxRecursionSteps: maximum values and fragments resolved, in total
+		- deadline: maximum wall-clock seconds
+	"""
+
+	def __init__(self, maxInputLength=None, maxRulesScanned=None, 
+			maxRecursionSteps=None, deadline=None):
+		self.maxInputLength = maxInputLength
+		self.maxRulesScanned = maxRulesScanned
+		self.maxRecursionSteps = maxRecursionSteps
+		self.deadline = deadline
+
+class BudgetTracker:
+	"""Work done so far resolving one value, against a ResolutionBudget."""
+
+	def __init__(self, budget):
+		self.budget = budget
+		self.rulesScanned = 0
+		self.recursionSteps = 0
+		self.expires = None
+		if budget.deadline != None:
+			self.expires = timer() + budget.deadline
+
+	def checkLength(self, value):
+		if self.budget.maxInputLength != None and len(value) > self.budget.maxInputLength:
+			raise RuleBudgetException("Could not resolve value of " + str(len(value)) + 
+				" digits: maximum is " + str(self.budget.maxInputLength))
+
+	def step(self, value):
+		self.recursionSteps = self.recursionSteps + 1
+		if (self.budget.maxRecursionSteps != None and 
+				self.recursionSteps > self.budget.maxRecursionSteps):
+			raise RuleBudgetException("Exceeded " + str(self.budget.maxRecursionSteps) + 
+				" recursion steps resolving [" + value + "]")
+		if self.expires != None and timer() > self.expires:
+			raise RuleBudgetException("Exceeded deadline of " + str(self.budget.deadline) + 
+				" seconds resolving [" + value + "]")
+
+	def scanned(self, count):
+		self.rulesScanned = self.rulesScanned + count
+		if (self.budget.maxRulesScanned != None and 
+				self.rulesScanned > self.budget.maxRulesScanned):
+			raise RuleBudgetException("Exceeded " + str(self.budget.maxRulesScanned) + 
+				" rules scanned")
+
+class BulkResult:
+	"""Outcome of RuleEngine.resolveBuffer(): number of lines processed, bytes
+		written, and a list of (offset, reason) tuples for malformed lines.
+	"""
+
+	def __init__(self):
+		self.count = 0
+		self.bytesWritten = 0
+		self.errors = []
+
+	def addError(self, offset, reason):
+		self.errors.append((offset, reason))
+
+class LangParser:
+	"""Parses a .lang file into a RuleList in a single pass, collecting every
+		validation error (with line and column numbers) as a LangFileError 
+		rather than stopping at the first.
+	"""
+
+	def __init__(self, fileName=None):
+		self.fileName = fileName
+		self.ruleList = RuleList()
+		self.errors = []
+		self.base = None              ## Base locale, if declared
+		self.baseLineNumber = None
+
+	def parseFile(self):
+		f = open(self.fileName, 'r')
+		try:
+			return self.parseLines(f)
+		finally:
+			f.close()
+
+	def parseLines(self, lines):
+		lineNumber = 0
+		for line in lines:
+			lineNumber = lineNumber + 1
+			self.parseLine(line, lineNumber)
+		logger.debug("parsed " + str(lineNumber) + " lines, " + 
+			str(len(self.ruleList)) + " rules, " + str(len(self.errors)) + " errors")
+		return self.ruleList
+
+	def parseLine(self, line, lineNumber):
+		try:
+			directive = validateAndParseDirective(line)
+			if directive != None and directive[0] == baseDirective:
+				if localePattern.match(directive[1]) == None:
+					raise RuleValidationException("Could not validate base locale: [" +
+						directive[1] + "]", line.find("=") + 1)
+				self.base = directive[1]
+				self.baseLineNumber = lineNumber
+				return
+			if directive != None:
+				self.ruleList.setDirective(directive[0], directive[1])
+				return
+			rule = validateAndParseRule(line)
+			if rule != None:
+				rule.lineNumber = lineNumber
+				self.ruleList.add(rule)
+		except RuleValidationException as e:
+			column = 1 if e.column == None else e.column + 1
+			self.errors.append(LangFileError(self.fileName, lineNumber, column, e.value))
+
+class LangFileError:
+	"""A validation error at a (1-based) line and column of a .lang file."""
+
+	def __init__(self, fileName, lineNumber, column, message):
+		self.fileName = fileName
+		self.lineNumber = lineNumber
+		self.column = column
+		self.message = message
+
+	def __str__(self):
+		return (str(self.fileName) + ":" + str(self.lineNumber) + ":" + 
+			str(self.column) + ": " + self.message)
+
+class LangLoader:
+	"""Loads RuleEngines for the .lang files in a directory, by locale (the 
+		file name without '.lang').  A file may declare a base locale, e.g.:
+		@base=fr_FR
+		and then only override or add rules (see RuleList.inherit).  Each 
+		locale is loaded once, so all overlays on a base share its Rule 
+		objects and, where unchanged, its compiled plans.
+
+		If 'warmSetFileName' names a warm set (see warmset.py), each engine
+		preloads its locale's values from it, up to 'warmMaxBytes' each (see
+		RuleEngine.preload).
+	"""
+
+	def __init__(self, path, inline=True, cache=None, warmSetFileName=None, 
+			warmMaxBytes=None):
+		self.path = path
+		self.inline = inline
+		self.cache = cache
+		self.warmSetFileName = warmSetFileName
+		self.warmMaxBytes = warmMaxBytes
+		self.warmSet = None
+		self.engines = {}
+		self.loading = []
+
+	def load(self, locale, fileName=None):
+		"""Returns the RuleEngine for 'locale', loading it (and its bases) if
+			necessary.
+		"""
+		if locale in self.engines:
+			return self.engines[locale]
+		if locale in self.loading:
+			raise RuleValidationException("Base locales form a cycle: " + 
+				" -> ".join(self.loading + [locale]))
+		if fileName == None:
+			fileName = os.path.join(self.path, locale + ".lang")
+		if not os.path.exists(fileName):
+			raise RuleValidationException("Could not load [" + fileName + 
+				"]: file not found")
+		parser = LangParser(fileName)
+		ruleList = parser.parseFile()
+		if parser.errors:
+			raise RuleValidationException("Could not load [" + fileName + "]:\n" +
+				"\n".join([str(error) for error in parser.errors]))
+		base = None
+		if parser.base != None:
+			self.loading.append(locale)
+			try:
+				base = self.load(parser.base)
+			finally:
+				self.loading.pop()
+			ruleList.inherit(base.ruleList)
+		engine = RuleEngine(ruleList, self.inline, base)
+		if self.cache != None:
+			engine.attachCache(self.cache, locale)
+		if self.warmSetFileName != None:
+			if self.warmSet == None:
+				self.warmSet = readWarmSet(self.warmSetFileName)
+			engine.preload([value for entryLocale, value, count in self.warmSet 
+				if entryLocale == locale], self.warmMaxBytes)
+		self.engines[locale] = engine
+		return engine
+
+	def loadAll(self):
+		"""Loads every .lang file in the directory, returning a dict of 
+			RuleEngines by locale.
+		"""
+		for fileName in sorted(os.listdir(self.path or ".")):
+			if fileName.endswith(".lang"):
+				self.load(fileName[:-len(".lang")])
+		return self.engines
+
+def checkLangFile(fileName):
+	"""Validates a .lang file without building a RuleEngine, returning a list
+		of LangFileError (empty if the file is valid).  Recursion between rules
+		is checked (see RuleGraph) once every line is valid.  If the file
+		declares a base locale, the base is loaded and the rules checked as an
+		overlay on it; errors in base rules are reported at the @base line.
+	"""
+	parser = LangParser(fileName)
+	ruleList = parser.parseFile()
+	if parser.errors:
+		return parser.errors
+	ownRules = set(ruleList.rules)
+	baseGraph = None
+	if parser.base != None:
+		try:
+			base = LangLoader(os.path.dirname(fileName)).load(parser.base)
+		except RuleValidationException as e:
+			return [LangFileError(fileName, parser.baseLineNumber, 1, str(e.value))]
+		ruleList.inherit(base.ruleList)
+		baseGraph = base.ruleGraph
+	return [LangFileError(fileName, 
+			rule.lineNumber if rule in ownRules else parser.baseLineNumber, 1, message) 
+		for rule, message in RuleGraph(ruleList, baseGraph).errors]
+
+class ShadowEngine:
+	"""Runs a candidate engine alongside a reference RuleEngine, to check that
+		the candidate (e.g. an optimised engine) produces identical output.
+
+		Calls to resolve() and render() always return the reference result.  A
+		proportion 'sampleRate' of calls (0.0 to 1.0) are also made against the
+		candidate, and any difference in output is recorded as a
+		ShadowMismatch, up to 'maxMismatches'.  Time spent in each engine on
+		compared calls is accumulated, for comparing latency.
+	"""
+
+	def __init__(self, reference, candidate, sampleRate=1.0, maxMismatches=1000):
+		self.reference = reference
+		self.candidate = candidate
+		self.sampleRate = sampleRate
+		self.maxMismatches = maxMismatches
+		self.random = random.Random()
+		self.mismatches = []
+		self.comparisons = 0
+		self.mismatchCount = 0
+		self.referenceTime = 0.0
+		self.candidateTime = 0.0
+
+	def resolve(self, value):
+		return self.shadow("resolve", value, self.random.random() < self.sampleRate)
+
+	def render(self, value):
+		return self.shadow("render", value, self.random.random() < self.sampleRate)
+
+	def shadow(self, method, value, compare=True):
+		if not compare:
+			return getattr(self.reference, method)(value)
+		start = timer()
+		expected = getattr(self.reference, method)(value)
+		self.referenceTime = self.referenceTime + (timer() - start)
+		start = timer()
+		try:
+			actual = getattr(self.candidate, method)(value)
+		except Exception as e:
+			actual = e
+		self.candidateTime = self.candidateTime + (timer() - start)
+		self.comparisons = self.comparisons + 1
+		if type(actual) != type(expected) or actual != expected:
+			self.recordMismatch(method, value, expected, actual)
+		return expected
+
+	def recordMismatch(self, method, value, expected, actual):
+		self.mismatchCount = self.mismatchCount + 1
+		logger.debug("shadow mismatch for " + method + "(" + value + ")")
+		if len(self.mismatches) < self.maxMismatches:
+			matchedRule = self.reference.ruleList.search(value)
+			self.mismatches.append(ShadowMismatch(method, value,
+				None if matchedRule is None else matchedRule.lhs, expected, actual))
+
+	def compareRange(self, start, stop, method="resolve"):
+		"""Compares the engines on every value in range(start, stop), returning
+			the number of mismatches found.
+		"""
+		mismatchCount = self.mismatchCount
+		for value in range(start, stop):
+			self.shadow(method, str(value))
+		return self.mismatchCount - mismatchCount
+
+	def report(self):
+		"""Returns a one-line summary of comparisons, mismatches and mean
+			latency per call of each engine.
+		"""
+		calls = max(self.comparisons, 1)
+		return ("compared=" + str(self.comparisons) +
+			" mismatches=" + str(self.mismatchCount) +
+			" referenceMeanSecs=" + "%.9f" % (self.referenceTime / calls) +
+			" candidateMeanSecs=" + "%.9f" % (self.candidateTime / calls))
+
+class ShadowMismatch:
+	"""A difference between reference and candidate output for one value, with
+		the lhs of the reference rule which matched it.
+	"""
+
+	def __init__(self, method, value, ruleLhs, expected, actual):
+		self.method = method
+		self.value = value
+		self.ruleLhs = ruleLhs
+		self.expected = expected
+		self.actual = actual
+
+	def __str__(self):
+		return (self.method + "(" + self.value + ") rule [" + str(self.ruleLhs) +
+			"]: expected " + repr(self.expected) + ", got " + repr(self.actual))
+
+class RangeAggregate:
+	"""Totals over a set of values: the number resolved ('count') and matching
+		no rule ('unresolved'), occurrences of each token ('tokenCounts'), and
+		of each rhs delimiter, ',' or '+' ('delimiterCounts').
+	"""
+
+	def __init__(self, renderDelimiters):
+		self.renderDelimiters = renderDelimiters
+		self.count = 0
+		self.unresolved = 0
+		self.tokenCounts = {}
+		self.delimiterCounts = {}
+
+	def addToken(self, token, n):
+		self.tokenCounts[token] = self.tokenCounts.get(token, 0) + n
+
+	def addDelimiter(self, delimiter, n):
+		self.delimiterCounts[delimiter] = self.delimiterCounts.get(delimiter, 0) + n
+
+	def addTokens(self, other, factor=1):
+		"""Adds the token and delimiter counts of 'other', 'factor' times."""
+		for token, n in other.tokenCounts.items():
+			self.addToken(token, n * factor)
+		for delimiter, n in other.delimiterCounts.items():
+			self.addDelimiter(delimiter, n * factor)
+
+	def totalTokens(self):
+		"""Total tokens, as returned by resolve()."""
+		return sum(self.tokenCounts.values())
+
+	def totalCharacters(self):
+		"""Total length of the strings returned by render()."""
+		return (sum([len(token) * n for token, n in self.tokenCounts.items()]) +
+			sum([len(self.renderDelimiters[delimiter]) * n 
+				for delimiter, n in self.delimiterCounts.items()]))
+
+	def totalDuration(self, clipLengths):
+		"""Total of the clip length of each token, from the dict 'clipLengths'
+			(e.g. seconds of audio per token).  Raises RuleUsageException if a
+			token has no clip length.
+		"""
+		total = 0
+		for token, n in self.tokenCounts.items():
+			if token not in clipLengths:
+				raise RuleUsageException("No clip length for token [" + token + "]")
+			total = total + clipLengths[token] * n
+		return total
+
+class RangeAggregator:
+	"""Computes RangeAggregates for RuleEngine.aggregate() by dynamic 
+		programming over the rules, without resolving each value.
+
+		A range is split into patterns of equal length, in which each position
+		allows a set of digits (see rangePatterns).  The values of a pattern
+		are partitioned between the rules which match them first, in search 
+		order.  For the part matched by a rule, each literal token is counted 
+		once per value, and each recursive token stands for a pattern of 
+		fragments, e.g. tu=($t0),($u) over 2?-5? gives the patterns 20-50 and
+		0-9, whose totals are computed the same way (once, as they are kept)
+		and scaled by the number of values sharing each fragment.
+	"""
+
+	def __init__(self, engine):
+		self.engine = engine
+		self.aggregates = {}
+		self.active = set()
+		self.rulesByLength = {}
+		for rule in engine.ruleList.rules:
+			masks = [1 << int(c) if c.isdigit() else None for c in rule.lhs]
+			varPositions = [pos for pos, c in enumerate(rule.lhs) if not c.isdigit()]
+			self.rulesByLength.setdefault(len(rule.lhs), []).append(
+				(rule, masks, varPositions, engine.buildPlan(rule)))
+
+	def aggregate(self, start, stop):
+		total = RangeAggregate(self.engine.renderDelimiters)
+		for pattern in rangePatterns(start, stop):
+			aggregate = self.aggregatePattern(pattern)
+			total.count = total.count + aggregate.count
+			total.unresolved = total.unresolved + aggregate.unresolved
+			total.addTokens(aggregate)
+		return total
+
+	def aggregatePattern(self, pattern):
+		"""Returns the RangeAggregate over every value matching 'pattern'."""
+		aggregate = self.aggregates.get(pattern)
+		if aggregate != None:
+			return aggregate
+		if pattern in self.active:
+			raise RuleEvaluationException("Recursion does not terminate aggregating [" +
+				describePattern(pattern) + "]")
+		self.active.add(pattern)
+		try:
+			aggregate = RangeAggregate(self.engine.renderDelimiters)
+			remaining = [pattern]
+			for rule, masks, varPositions, plan in self.rulesByLength.get(len(pattern), []):
+				if not remaining:
+					break
+				unmatched = []
+				for part in remaining:
+					matched = self.splitPattern(part, masks, unmatched)
+					if matched != None:
+						self.addRule(aggregate, rule, matched, varPositions, plan)
+				remaining = unmatched
+			for part in remaining:
+				aggregate.unresolved = aggregate.unresolved + patternSize(part)
+		finally:
+			self.active.discard(pattern)
+		self.aggregates[pattern] = aggregate
+		return aggregate
+
+	def splitPattern(self, pattern, masks, unmatched):
+		"""Returns the part of 'pattern' matched by a rule's lhs 'masks', or 
+			None, appending the rest to 'unmatched' as disjoint patterns.
+		"""
+		for allowed, mask in zip(pattern, masks):
+			if mask != None and not (allowed & mask):
+				unmatched.append(pattern)
+				return None
+		matched = list(pattern)
+		for pos, mask in enumerate(masks):
+			if mask != None and pattern[pos] != mask:
+				part = list(matched)
+				part[pos] = pattern[pos] & ~mask
+				unmatched.append(tuple(part))
+				matched[pos] = mask
+		return tuple(matched)
+
+	def addRule(self, aggregate, rule, pattern, varPositions, plan):
+		"""Adds the totals for resolving every value of 'pattern' by 'rule'."""
+		count = patternSize(pattern)
+		aggregate.count = aggregate.count + count
+		for delimiter in rule.rhsDelimiterList:
+			aggregate.addDelimiter(delimiter, count)
+		varMasks = [pattern[pos] for pos in varPositions]
+		for kind, template, data in plan:
+			if template.__class__ is str:
+				template = (template,)
+			groups = sorted(set([x for x in template if x.__class__ is int]))
+			## Each combination of the token's digivars occurs 'factor' times
+			factor = count
+			for group in groups:
+				factor = factor // patternSize((varMasks[group],))
+			if kind == tokenLiteral:
+				for digits in itertools.product(*[maskDigits(varMasks[g]) for g in groups]):
+					values = dict(zip(groups, digits))
+					aggregate.addToken("".join([values[x] if x.__class__ is int else x 
+						for x in template]), factor)
+				continue
+			## Digivars used more than once in a fragment are enumerated, the 
+			## rest stand for every digit they allow
+			repeated = [g for g in groups if template.count(g) > 1]
+			for digits in itertools.product(*[maskDigits(varMasks[g]) for g in repeated]):
+				values = dict(zip(repeated, digits))
+				fragment = []
+				for x in template:
+					if x.__class__ is not int:
+						fragment.extend([1 << int(c) for c in x])
+					elif x in values:
+						fragment.append(1 << int(values[x]))
+					else:
+						fragment.append(varMasks[x])
+				fragmentAggregate = self.aggregatePattern(tuple(fragment))
+				if fragmentAggregate.unresolved > 0:
+					raise RuleEvaluationException("Could not match fragment of result [" +
+						describePattern(fragment) + "] to a rule")
+				aggregate.addTokens(fragmentAggregate, factor)
+
+def rangePatterns(start, stop):
+	"""Splits range(start, stop) (ignoring negative values) into patterns: 
+		tuples with a bitmask of the digits allowed at each position, which 
+		between them match the decimal string of each value exactly once.
+	"""
+	patterns = []
+	low = max(start, 0)
+	while low < stop:
+		length = len(str(low))
+		high = min(stop - 1, 10 ** length - 1)
+		addRangePatterns(str(low), str(high), [], patterns)
+		low = 10 ** length
+	return patterns
+
+def addRangePatterns(low, high, prefix, patterns):
+	"""Appends patterns for the digit strings from 'low' to 'high' (of equal
+		length), each following the bitmasks in 'prefix'.
+	"""
+	if low == "":
+		patterns.append(tuple(prefix))
+		return
+	first = int(low[0])
+	last = int(high[0])
+	if first == last:
+		addRangePatterns(low[1:], high[1:], prefix + [1 << first], patterns)
+		return
+	rest = len(low) - 1
+	if low[1:] != "0" * rest:
+		addRangePatterns(low[1:], "9" * rest, prefix + [1 << first], patterns)
+		first = first + 1
+	if high[1:] != "9" * rest:
+		addRangePatterns("0" * rest, high[1:], prefix + [1 << last], patterns)
+		last = last - 1
+	if first <= last:
+		mask = (allDigitsMask >> (9 - last)) & ~((1 << first) - 1)
+		patterns.append(tuple(prefix + [mask] + [allDigitsMask] * rest))
+
+def patternSize(pattern):
+	"""The number of digit strings matching 'pattern'."""
+	size = 1
+	for mask in pattern:
+		size = size * bin(mask).count("1")
+	return size
+
+def maskDigits(mask):
+	return [str(d) for d in range(10) if mask & (1 << d)]
+
+def describePattern(pattern):
+	"""e.g. '2?' for a pattern allowing one digit then several."""
+	return "".join([maskDigits(mask)[0] if bin(mask).count("1") == 1 else "?" 
+		for mask in pattern])
+
+def parseRequest(line):
+	"""Parses an access log line for a request to nnjson.py, e.g. (in common
+		or combined log format):
+		1.2.3.4 - - [19/Oct/2026:10:00:00 +0000] "GET /nnjson.py?value=21&lang=en_GB HTTP/1.1" 200 52
+		or a histogram line of the form '<locale> <value> <count>', returning 
+		a (locale, value, count) tuple.  Returns None for any other line, and
+		for requests which failed (status 4xx or 5xx) or lack a valid 'lang'
+		or 'value' parameter.
+	"""
+	match = accessLogPattern.search(line)
+	if match != None:
+		if match.group(2) != None and match.group(2)[0] in "45":
+			return None
+		query = parse_qs(match.group(1))
+		if "lang" not in query or "value" not in query:
+			return None
+		fields = [query["lang"][0], query["value"][0], "1"]
+	else:
+		fields = line.split()
+		if len(fields) != 3:
+			return None
+	if (localePattern.match(fields[0]) == None or 
+			valueValidatorPattern.match(fields[1]) == None or 
+			valueValidatorPattern.match(fields[2]) == None):
+		return None
+	return (fields[0], fields[1], int(fields[2]))
+
+def countRequests(lines):
+	"""Counts the requests in lines accepted by parseRequest(), returning a 
+		dict of (locale, value) to count.  Other lines are ignored.
+	"""
+	counts = {}
+	for line in lines:
+		request = parseRequest(line)
+		if request == None:
+			continue
+		key = request[0:2]
+		counts[key] = counts.get(key, 0) + request[2]
+	return counts
+
+def buildWarmSet(counts, maxEntries=None):
+	"""Returns a warm set: (locale, value, count) tuples from countRequests()
+		counts, most frequent first, limited to 'maxEntries'.
+	"""
+	warmSet = [(locale, value, count) for (locale, value), count in counts.items()]
+	warmSet.sort(key=lambda entry: (-entry[2], entry[0], len(entry[1]), entry[1]))
+	if maxEntries != None:
+		warmSet = warmSet[:maxEntries]
+	return warmSet
+
+def writeWarmSet(fileName, warmSet):
+	"""Writes a warm set as tab-separated 'locale, value, count' lines."""
+	f = open(fileName, 'w')
+	try:
+		for locale, value, count in warmSet:
+			f.write(locale + "\t" + value + "\t" + str(count) + "\n")
+	finally:
+		f.close()
+
+def readWarmSet(fileName, locale=None):
+	"""Reads a warm set written by writeWarmSet().  If 'locale' is given, 
+		returns just its values (most frequent first), for RuleEngine.preload().
+	"""
+	warmSet = []
+	f = open(fileName, 'r')
+	try:
+		for line in f:
+			fields = line.rstrip("\n").split("\t")
+			if len(fields) == 3:
+				warmSet.append((fields[0], fields[1], int(fields[2])))
+	finally:
+		f.close()
+	if locale == None:
+		return warmSet
+	return [value for entryLocale, value, count in warmSet if entryLocale == locale]
+
+def warmSetCoverage(warmSet, counts):
+	"""Returns a dict of locale to (requests covered by the warm set, total
+		requests), for request counts from countRequests().
+	"""
+	warmKeys = set([(locale, value) for locale, value, count in warmSet])
+	coverage = {}
+	for key, count in counts.items():
+		covered, total = coverage.get(key[0], (0, 0))
+		if key in warmKeys:
+			covered = covered + count
+		coverage[key[0]] = (covered, total + count)
+	return coverage
+
+def compileTemplate(template):
+	"""Compiles an rhs token with backreferences (e.g. '\\g<1>0') into a tuple
+		of literal strings and 0-based group indexes, for expandTemplate().  A
+		token without backreferences is returned unchanged, as a string.
+	"""
+	pieces = backrefPattern.split(template)
+	if len(pieces) == 1:
+		return template
+	compiled = []
+	for i, piece in enumerate(pieces):
+		if i % 2 == 1:
+			compiled.append(int(piece) - 1)
+		elif piece != "":
+			compiled.append(piece)
+	return tuple(compiled)
+
+def expandTemplate(template, groups):
+	"""Expands a template from compileTemplate() with the groups of a match."""
+	if template.__class__ is str:
+		return template
+	return "".join([groups[x] if x.__class__ is int else x for x in template])
+
+def validateAndParseDirective(line):
+	"""Parses a rendering directive line of the form '@<name>=<value>', e.g.:
+		@separator=" "
+		The value may be enclosed in double quotes, to allow spaces or an empty
+		value.  Any characters after '#' are ignored.
+
+		Return values:
+		- If the line is a valid directive, a (name, value) tuple
+		- If the line starts with '@' but is invalid, a RuleValidationException
+		  will be raised
+		- If the line is not a directive, None will be returned
+	"""
+	line = line.lstrip()
+	if line[0:1] != '@':
+		return None
+	commentCharPos = line.find('#')
+	if commentCharPos != -1:
+		line = line[:commentCharPos]
+	match = re.match(directiveValidatorRegex, line.rstrip())
+	if match == None or (match.group(1) not in directiveDefaults and 
+			match.group(1) != baseDirective):
+		raise RuleValidationException("Could not validate directive: [" +
+			line.rstrip() + "].  Known directives are: " +
+			", ".join(sorted(list(directiveDefaults) + [baseDirective])))
+	value = match.group(2)
+	if len(value) >= 2 and value[0] == '"' and value[-1] == '"':
+		value = value[1:-1]
+	return (match.group(1), value)
 
 def validateAndParseRule(rule):
 	"""Validates and parses entire rule string, returning it as a Rule object.  
@@ -313,8 +2119,6 @@ def validateAndParseRule(rule):
 		- If rule is invalid, a RuleValidationException will be raised
 		- If rule was only a comment, None will be returned
 	"""
-	logger.debug("validateAndParseRule()")
-
 	# Get rule without comments, return None if rule is only a comment
 	commentCharPos = rule.find('#')
 	if commentCharPos != -1:
@@ -327,7 +2131,7 @@ def validateAndParseRule(rule):
 	# Check that rule without comment is some chars, delimited by '='
 	if (re.match(ruleValidatorRegex, ruleWithoutComment) == None):
 		raise RuleValidationException("Could not validate rule: [" + 
-			rule + "].  Format should be: <lhs>=<rhs>")
+			rule.rstrip() + "].  Format should be: <lhs>=<rhs>", 0)
 
 	# Split rule into LHS and RHS, create Rule object and run its validations
 	parts = ruleWithoutComment.split('=')
@@ -0,0 +1,105 @@
+import asyncio
+
+class AsyncResolver:
+	"""Asyncio front end to a RuleEngine, used by RuleEngine.aresolve() and
+		RuleEngine.arender().
+
+		Resolution runs in an executor, off the event loop.  Concurrent requests
+		for the same value share one pending result, and distinct requests are
+		collected into batches of up to 'maxBatchSize', each submitted to the
+		executor once full or 'maxDelay' seconds after its first request.  At
+		most 'maxPending' distinct values may be pending; further requests wait
+		for a free slot.  'executor' is a concurrent.futures executor, or None
+		for the loop's default.
+	"""
+
+	def __init__(self, engine, maxBatchSize=64, maxDelay=0.002, maxPending=1024,
+			executor=None):
+		self.engine = engine
+		self.maxBatchSize = maxBatchSize
+		self.maxDelay = maxDelay
+		self.maxPending = maxPending
+		self.executor = executor
+		self.pending = {}
+		self.batch = []
+		self.flushHandle = None
+		self.slots = None
+		self.loop = None
+		self.coalesced = 0
+		self.batches = 0
+
+	async def resolve(self, value):
+		return await self.submit("resolve", value)
+
+	async def render(self, value):
+		return await self.submit("render", value)
+
+	async def submit(self, method, value):
+		loop = asyncio.get_running_loop()
+		if loop is not self.loop:
+			## Pending state belongs to one event loop; start afresh on another
+			self.loop = loop
+			self.pending = {}
+			self.batch = []
+			self.flushHandle = None
+			self.slots = asyncio.Semaphore(self.maxPending)
+		key = (method, value)
+		future = self.pending.get(key)
+		if future != None:
+			self.coalesced = self.coalesced + 1
+			return await asyncio.shield(future)
+		await self.slots.acquire()
+		## Another request may have submitted this value while we waited
+		future = self.pending.get(key)
+		if future != None:
+			self.slots.release()
+			self.coalesced = self.coalesced + 1
+			return await asyncio.shield(future)
+		future = loop.create_future()
+		self.pending[key] = future
+		self.batch.append(key)
+		if len(self.batch) >= self.maxBatchSize:
+			self.flush()
+		elif self.flushHandle == None:
+			self.flushHandle = loop.call_later(self.maxDelay, self.flush)
+		return await asyncio.shield(future)
+
+	def flush(self):
+		"""Submits the current batch to the executor."""
+		if self.flushHandle != None:
+			self.flushHandle.cancel()
+			self.flushHandle = None
+		if not self.batch:
+			return
+		keys = self.batch
+		self.batch = []
+		self.batches = self.batches + 1
+		task = self.loop.run_in_executor(self.executor, self.resolveBatch, keys)
+		pending = self.pending
+		slots = self.slots
+		task.add_done_callback(lambda task: self.complete(keys, task, pending, slots))
+
+	def resolveBatch(self, keys):
+		results = []
+		for method, value in keys:
+			try:
+				results.append((getattr(self.engine, method)(value), None))
+			except Exception as e:
+				results.append((None, e))
+		return results
+
+	def complete(self, keys, task, pending, slots):
+		if task.cancelled() or task.exception() != None:
+			error = RuntimeError("batch failed") if task.cancelled() else task.exception()
+			results = [(None, error)] * len(keys)
+		else:
+			results = task.result()
+		for key, (result, error) in zip(keys, results):
+			future = pending.pop(key)
+			slots.release()
+			if future.done():
+				continue
+			if error != None:
+				future.set_exception(error)
+			else:
+				future.set_result(result)
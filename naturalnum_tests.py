@@ -1,4 +1,11 @@
 import unittest
+import io
+import os
+import json
+import shutil
+import subprocess
+import tempfile
+import runpy
 from naturalnum import *
 import logging.config
 
@@ -16,7 +23,7 @@ class TestNaturalNum(unittest.TestCase):
 		## Trigger load of valid config file and ensure everything is set up
 		cfgFilename = "config/en_GB.lang"  # todo create seperate test config file
 		ruleEngine = RuleEngine.fromLangFilename(cfgFilename)
-		self.assertEquals(44, len(ruleEngine.ruleList))
+		self.assertEquals(45, len(ruleEngine.ruleList))
 		
 	def testValidateLhs(self):
 		logger.info("testValidateLhs()")
@@ -42,6 +49,11 @@ class TestNaturalNum(unittest.TestCase):
 		rule.init()
 		self.assertEquals(5, len(rule.rhsTokenList))
 
+		rule = Rule("tu", "($u)+und+($t0),x")
+		rule.init()
+		self.assertEqual(["(\\g<2>)", "und", "(\\g<1>0)", "x"], rule.rhsTokenList)
+		self.assertEqual(["+", "+", ","], rule.rhsDelimiterList)
+
 	def testValidateRhs(self):
 		## Ensure only alphanumerics, '(', ')', ',', '$' allowed
 		self.assertRaises(RuleValidationException, Rule(None, "").validateRhs)
@@ -192,6 +204,528 @@ class TestNaturalNum(unittest.TestCase):
 	def testRuleEngineResolve(self):
 		eng = RuleEngine.fromLangFilename("config/en_GB.lang")
 		self.assertEquals(["one", "thousand", "two", "hundred", "and", "thirty", "four"], eng.resolve("1234"))
+
+		## Digivars do not match a newline, as in Rule.lhsRegex
+		self.assertEqual(None, eng.resolve("12\n"))
+		self.assertEqual(None, eng.resolve("1\n2"))
+		self.assertEqual(None, ResolverSession(eng).setValue("12\n"))
+
+	def testRuleEngineResolveBuffer(self):
+		eng = RuleEngine.fromLangFilename("config/en_GB.lang")
+		out = io.BytesIO()
+		result = eng.resolveBuffer(b"21\n\n1x\r\n100\r\n21", out)
+		self.assertEqual(b"twenty,one\n\none,hundred\ntwenty,one\n", out.getvalue())
+		self.assertEqual(4, result.count)
+		self.assertEqual([(4, "not a digits-only value")], result.errors)
+
+		## Pre-sized output buffer, filled in place
+		buf = bytearray(20)
+		result = eng.resolveBuffer(memoryview(b"7\n12\n"), buf, " ")
+		self.assertEqual(b"seven\ntwelve\n", bytes(buf[:result.bytesWritten]))
+		self.assertRaises(RuleUsageException, eng.resolveBuffer, b"7\n12\n", bytearray(8))
+
+		## CRLF blank lines are skipped too
+		out = io.BytesIO()
+		result = eng.resolveBuffer(b"5\r\n\r\n7\r\n", out)
+		self.assertEqual((b"five\nseven\n", 2, []), (out.getvalue(), result.count, result.errors))
+
+		## Values which fail to resolve are reported, as is runaway recursion
+		eng = RuleEngine(LangParser().parseLines(["u=unit\n", "1u=($u2)\n", "2u=($u1)\n"]))
+		for maxDepth in [resolveMaxDepth, None]:
+			eng.maxDepth = maxDepth
+			out = io.BytesIO()
+			result = eng.resolveBuffer(b"5\n12\n7\n", out)
+			self.assertEqual(b"unit\n\nunit\n", out.getvalue())
+			self.assertEqual([2], [offset for offset, reason in result.errors])
+
+	def testRuleEngineResolveFile(self):
+		eng = RuleEngine.fromLangFilename("config/en_GB.lang")
+		tmpDir = tempfile.mkdtemp()
+		try:
+			inFileName = os.path.join(tmpDir, "in.txt")
+			outFileName = os.path.join(tmpDir, "out.txt")
+			f = open(inFileName, "wb")
+			f.write(b"5\n1234567\n")
+			f.close()
+			result = eng.resolveFile(inFileName, outFileName)
+			self.assertEqual([(2, "no rule matches value")], result.errors)
+			f = open(outFileName, "rb")
+			self.assertEqual(b"five\n\n", f.read())
+			f.close()
+		finally:
+			shutil.rmtree(tmpDir)
+
+	def testValidateAndParseDirective(self):
+		self.assertEqual(None, validateAndParseDirective("1=one"))
+		self.assertEqual(("separator", " "), validateAndParseDirective('@separator=" " # comment'))
+		self.assertEqual(("joiner", ""), validateAndParseDirective('@joiner=""'))
+		self.assertEqual(("joiner", "-"), validateAndParseDirective("@joiner=-"))
+		self.assertRaises(RuleValidationException, validateAndParseDirective, "@unknown=x")
+		self.assertRaises(RuleValidationException, validateAndParseDirective, "@joiner")
+
+	def testRuleEngineRender(self):
+		ruleList = RuleList()
+		for lhs, rhs in [("3", "drei"), ("1u", "($u)+zehn"), ("h13", "$h,(13)")]:
+			rule = Rule(lhs, rhs)
+			rule.init()
+			ruleList.add(rule)
+		ruleList.setDirective("separator", "_")
+		ruleEngine = RuleEngine(ruleList)
+		self.assertEqual(["drei", "zehn"], ruleEngine.resolve("13"))
+		self.assertEqual("dreizehn", ruleEngine.render("13"))
+		self.assertEqual("5_dreizehn", ruleEngine.render("513"))
+		self.assertEqual(None, ruleEngine.render("99"))
+
+		eng = RuleEngine.fromLangFilename("config/fr_FR.lang")
+		self.assertEqual("cent vingt-deux", eng.render("122"))
+		eng = RuleEngine.fromLangFilename("config/de_DE.lang")
+		self.assertEqual("einundzwanzig", eng.render("21"))
+
+	def testShadowEngine(self):
+		reference = RuleEngine.fromLangFilename("config/en_GB.lang")
+		candidate = RuleEngine.fromLangFilename("config/en_GB.lang")
+		candidate.ruleList.rules.insert(0, validateAndParseRule("1tu=one,hundred,($t$u)"))
+		candidate.compile()
+		shadow = ShadowEngine(reference, candidate)
+		self.assertEqual(reference.resolve("121"), shadow.resolve("121"))
+		self.assertEqual(0, shadow.compareRange(0, 100))
+		self.assertEqual(100, shadow.compareRange(100, 200, "render"))
+		self.assertEqual(201, shadow.comparisons)
+		mismatch = shadow.mismatches[-1]
+		self.assertEqual(("199", "htu"), (mismatch.value, mismatch.ruleLhs))
+		self.assertEqual("one hundred ninety nine", mismatch.actual)
+
+		## Unsampled calls are not compared
+		shadow = ShadowEngine(reference, candidate, sampleRate=0.0)
+		shadow.resolve("121")
+		self.assertEqual(0, shadow.comparisons)
+
+	def testLangParser(self):
+		## All errors are collected, with line and column numbers
+		parser = LangParser("test.lang")
+		ruleList = parser.parseLines(["1=one\n", "# comment\n", "hh=($h)\n", "2=two\n",
+			"tu=($t0),x($u)\n", "u=$v\n", "@unknown=1\n", "nonsense\n"])
+		self.assertEqual(2, len(ruleList))
+		self.assertEqual([(3, 2), (5, 11), (6, 3), (7, 1), (8, 1)],
+			[(e.lineNumber, e.column) for e in parser.errors])
+		self.assertTrue(str(parser.errors[0]).startswith("test.lang:3:2: "))
+
+		## Valid configs have no errors; invalid ones fail to load with all errors
+		self.assertEqual([], checkLangFile("config/fr_FR.lang"))
+		tmpDir = tempfile.mkdtemp()
+		try:
+			fileName = os.path.join(tmpDir, "bad.lang")
+			f = open(fileName, "w")
+			f.write("1=($x)\n2=$2\n")
+			f.close()
+			self.assertEqual(2, len(checkLangFile(fileName)))
+			self.assertRaises(RuleValidationException, RuleEngine.fromLangFilename, fileName)
+		finally:
+			shutil.rmtree(tmpDir)
+
+	def testRuleGraph(self):
+		parser = LangParser()
+		ruleList = parser.parseLines(["1=one\n", "u=($u)\n", "tu=($t$u)\n",
+			"1u=($u),teen\n", "htu=($h000)\n", "hu=($h),($u)\n"])
+		graph = RuleGraph(ruleList)
+		self.assertEqual(["u", "tu", "htu"], [rule.lhs for rule, message in graph.errors])
+		self.assertTrue(graph.errors[1][1].endswith("tu -> tu"))
+		self.assertRaises(RuleValidationException, RuleEngine, ruleList)
+		self.assertEqual(["1", "u"], [rule.lhs for rule in graph.edges[ruleList.rules[3]]])
+		self.assertEqual(["1", "u"], [rule.lhs for rule in graph.edges[ruleList.rules[1]]])
+
+		## A token mapping a value to itself is reported, though the step is not
+		## definite (u matches '1' first, but '0' maps to itself)
+		self.assertTrue(graph.errors[0][1].endswith("does not terminate for value [0]"))
+		ruleList = LangParser().parseLines(["u=unit\n", "10=ten\n", "tu=($t0),($u)\n"])
+		self.assertEqual(["does not terminate for value [00]"], 
+			[message[-33:] for rule, message in RuleGraph(ruleList).errors])
+		ruleList = LangParser().parseLines(["u=unit\n", "0u=($u)\n", "t0=tens\n", 
+			"tu=($t0),($u)\n"])
+		self.assertEqual([], RuleGraph(ruleList).errors)
+
+		## Longer cycles which are not definite fail at runtime, within a depth 
+		## limit: 12 -> 22 -> 21 -> 11 -> 12
+		ruleList = LangParser().parseLines(["1u=($u2)\n", "2u=($u1)\n"])
+		eng = RuleEngine(ruleList)
+		self.assertRaises(RuleEvaluationException, eng.resolve, "12")
+		self.assertRaises(RuleEvaluationException, ResolverSession(eng).setValue, "12")
+
+	def testRuleEngineInline(self):
+		eng = RuleEngine.fromLangFilename("config/fr_FR.lang")
+		plan = eng.plans[eng.ruleList.search("31")]
+		self.assertEqual([tokenTable, tokenLiteral, tokenFixed], [step[0] for step in plan])
+		self.assertEqual((["un"], "un"), plan[2][2])
+		self.assertEqual((["trente"], "trente"), plan[0][2]["30"])
+
+		reference = RuleEngine.fromLangFilename("config/fr_FR.lang", inline=False)
+		shadow = ShadowEngine(reference, eng)
+		self.assertEqual(0, shadow.compareRange(0, 2000))
+		self.assertEqual(0, shadow.compareRange(0, 2000, "render"))
+
+	def testCompileTemplate(self):
+		self.assertEqual("one", compileTemplate("one"))
+		template = compileTemplate(r"\g<2>0\g<1>")
+		self.assertEqual((1, "0", 0), template)
+		self.assertEqual("504", expandTemplate(template, ("4", "5")))
+
+	def testSqliteResolutionCache(self):
+		tmpDir = tempfile.mkdtemp()
+		try:
+			dbFileName = os.path.join(tmpDir, "cache.db")
+			langFileName = os.path.join(tmpDir, "en_GB.lang")
+			shutil.copy("config/en_GB.lang", langFileName)
+
+			## A second cache connection (e.g. another process) sees stored results
+			cache = SqliteResolutionCache(dbFileName)
+			eng = RuleEngine.fromLangFilename(langFileName, cache=cache)
+			self.assertEqual(["twenty", "one"], eng.resolve("21"))
+			self.assertEqual("twenty one", eng.render("21"))
+			otherCache = SqliteResolutionCache(dbFileName)
+			self.assertEqual(["twenty", "one"],
+				otherCache.get("en_GB", eng.ruleList.contentHash(), "resolve", "21"))
+			otherEng = RuleEngine.fromLangFilename(langFileName, cache=otherCache)
+			self.assertEqual("twenty one", otherEng.render("21"))
+			self.assertEqual(2, otherCache.hits)
+
+			## Results used again are served from memory, as copies
+			tokens = otherEng.resolve("21")
+			tokens.append("x")
+			self.assertEqual(["twenty", "one"], otherEng.resolve("21"))
+			self.assertEqual(2, otherCache.memoryHits)
+
+			## Entries for other versions of the rules are kept (e.g. while old
+			## and new versions run side by side), up to 'keepVersions' versions
+			oldHash = eng.ruleList.contentHash()
+			def cachedHashes():
+				return set([row[0] for row in otherCache.connection.execute(
+					"SELECT DISTINCT ruleHash FROM resolution")])
+			for version in range(3):
+				f = open(langFileName, "a")
+				f.write("\n2" + str(version) + "=vingt\n")
+				f.close()
+				newEng = RuleEngine.fromLangFilename(langFileName, cache=otherCache)
+				self.assertEqual(["twenty", "one"], newEng.resolve("21"))
+				self.assertEqual(version < 2, oldHash in cachedHashes())
+
+			## With a maximum age, versions not in use are deleted sooner
+			cache.close()
+			cache = SqliteResolutionCache(dbFileName, maxAge=0)
+			cache.purge("en_GB", newEng.ruleList.contentHash())
+			self.assertEqual(set([newEng.ruleList.contentHash()]), cachedHashes())
+			cache.close()
+			otherCache.close()
+		finally:
+			shutil.rmtree(tmpDir)
+
+	def testRuleEngineAresolve(self):
+		import asyncio
+		eng = RuleEngine.fromLangFilename("config/en_GB.lang")
+		eng.setAsyncOptions(maxBatchSize=4, maxDelay=0.01, maxPending=3)
+
+		async def run():
+			values = ["21", "21", "100", "5", "7", "21", "1000000"]
+			results = await asyncio.gather(*[eng.aresolve(v) for v in values])
+			rendered = await eng.arender("21")
+			return results, rendered
+
+		results, rendered = asyncio.run(run())
+		self.assertEqual(["twenty", "one"], results[0])
+		self.assertEqual(results[0], results[5])
+		self.assertEqual(["seven"], results[4])
+		self.assertEqual(None, results[6])
+		self.assertEqual("twenty one", rendered)
+		self.assertTrue(eng.asyncResolver.coalesced >= 2)
+		self.assertEqual({}, eng.asyncResolver.pending)
+
+	def testExportTableGolden(self):
+		f = open("naturalnum_golden.json")
+		golden = json.load(f)
+		f.close()
+		f = open("site/rules/index.json")
+		index = json.load(f)
+		f.close()
+		siteModule = runpy.run_path("site/naturalnum.py")
+		siteEngines = siteModule["LangLoader"]("site/config").loadAll()
+		for locale in golden:
+			## Golden results match the Python engine
+			eng = RuleEngine.fromLangFilename("config/" + locale + ".lang")
+			for value, tokens, rendered in golden[locale]:
+				self.assertEqual(tokens, eng.resolve(value))
+				self.assertEqual(rendered, eng.render(value))
+
+			## Exported tables in the site are up to date
+			f = open("site/rules/" + index["locales"][locale])
+			self.assertEqual(eng.exportTable(), json.load(f))
+			f.close()
+
+			## The site's server fallback loads the same rules, and its copy of the
+			## library gives the same results
+			f = open("config/" + locale + ".lang")
+			g = open("site/config/" + locale + ".lang")
+			self.assertEqual(f.read(), g.read())
+			f.close()
+			g.close()
+			siteEng = siteEngines[locale]
+			for value, tokens, rendered in golden[locale]:
+				self.assertEqual(tokens, siteEng.resolve(value))
+				self.assertEqual(rendered, siteEng.render(value))
+			self.assertEqual(None, siteEng.resolve("12\n"))
+
+		## The JavaScript evaluator gives the golden results
+		node = shutil.which("node")
+		if node == None:
+			self.skipTest("node is not installed")
+		script = """
+			var fs = require('fs');
+			var NaturalNum = require('./site/naturalnum.js');
+			var golden = JSON.parse(fs.readFileSync('naturalnum_golden.json', 'utf8'));
+			var index = JSON.parse(fs.readFileSync('site/rules/index.json', 'utf8'));
+			var failures = [];
+			for (var locale in golden) {
+				var eng = new NaturalNum(JSON.parse(
+					fs.readFileSync('site/rules/' + index.locales[locale], 'utf8')));
+				golden[locale].forEach(function(g) {
+					if (JSON.stringify(eng.resolve(g[0])) != JSON.stringify(g[1]) ||
+							eng.render(g[0]) !== g[2]) {
+						failures.push(locale + ':' + g[0]);
+					}
+				});
+			}
+			console.log(JSON.stringify(failures));
+		"""
+		output = subprocess.check_output([node, "-e", script])
+		self.assertEqual([], json.loads(output.decode("utf-8")))
+
+	def testResolverSession(self):
+		eng = RuleEngine.fromLangFilename("config/en_GB.lang", inline=False)
+		session = ResolverSession(eng)
+		for digit in "123456":
+			tokens = session.append(digit)
+			self.assertEqual(eng.resolve(session.value), tokens)
+			self.assertEqual(eng.render(session.value), session.render())
+		self.assertEqual(["nine"], session.replace(0, "9")[0:1])
+		self.assertEqual(eng.resolve("923456"), session.tokens())
+
+		## Only fragments containing the changed digit (923457, 457, 57, 7) are 
+		## resolved again; 923, 4 and 50 are reused
+		resolved = session.resolved
+		reused = session.reused
+		session.replace(5, "7")
+		self.assertEqual(eng.resolve("923457"), session.tokens())
+		self.assertEqual(4, session.resolved - resolved)
+		self.assertEqual(3, session.reused - reused)
+
+		## Fragments are kept while no rule matches, e.g. after a 7th digit
+		self.assertEqual(None, session.append("8"))
+		resolved = session.resolved
+		self.assertEqual(eng.resolve("923457"), session.backspace())
+		self.assertEqual(0, session.resolved - resolved)
+		self.assertEqual(None, session.setValue(""))
+		self.assertEqual(None, session.setValue("1234567"))
+
+		## The engine's budget applies
+		eng.setBudget(ResolutionBudget(maxInputLength=4, maxRecursionSteps=3))
+		self.assertRaises(RuleUsageException, session.setValue, "1x")
+		self.assertRaises(RuleBudgetException, session.setValue, "12345")
+		self.assertRaises(RuleBudgetException, session.setValue, "1234")
+		self.assertEqual(["twenty", "one"], session.setValue("21"))
+		self.assertEqual((1, 2), (eng.inputsRejected, eng.budgetsExceeded))
+
+	def testWarmSet(self):
+		get = '1.2.3.4 - - [19/Oct/2026:10:00:00 +0000] "GET /nnjson.py?'
+		counts = countRequests([get + 'value=21&lang=en_GB HTTP/1.1" 200 52', 
+			get + 'lang=en_GB&value=21 HTTP/1.1" 200 52 "-" "Mozilla/5.0"',
+			get + 'value=7&lang=fr_FR HTTP/1.1" 200 40', "bad",
+			get + 'value=5&lang=en_GB HTTP/1.0"', "fr_FR 80 10", "fr_FR x 1",
+			get + 'value=12%0A&lang=en_GB HTTP/1.1" 400 34',
+			get + 'value=1x&lang=en_GB HTTP/1.1" 200 34',
+			get + 'lang=en_GB HTTP/1.1" 200 34', "en_GB 21"])
+		self.assertEqual({("en_GB", "21"): 2, ("fr_FR", "7"): 1, ("en_GB", "5"): 1,
+			("fr_FR", "80"): 10}, counts)
+		self.assertEqual(None, parseRequest(get + 'value=12%0A&lang=en_GB HTTP/1.1" 200 34'))
+		warmSet = buildWarmSet(counts, 2)
+		self.assertEqual([("fr_FR", "80", 10), ("en_GB", "21", 2)], warmSet)
+		self.assertEqual({"en_GB": (2, 3), "fr_FR": (10, 11)}, warmSetCoverage(warmSet, counts))
+
+		tmpDir = tempfile.mkdtemp()
+		try:
+			fileName = os.path.join(tmpDir, "warm.txt")
+			writeWarmSet(fileName, warmSet)
+			self.assertEqual(warmSet, readWarmSet(fileName))
+			self.assertEqual(["21"], readWarmSet(fileName, "en_GB"))
+
+			## Engines preload their locale's values as they are loaded, as do
+			## those of the site's server fallback
+			engines = LangLoader("config", warmSetFileName=fileName).loadAll()
+			self.assertEqual(["21"], list(engines["en_GB"].preloaded))
+			self.assertEqual(["80"], list(engines["fr_FR"].preloaded))
+			self.assertEqual({}, engines["de_DE"].preloaded)
+			siteModule = runpy.run_path("site/naturalnum.py")
+			engines = siteModule["LangLoader"]("site/config", fileName).loadAll()
+			self.assertEqual(["21"], list(engines["en_GB"].preloaded))
+			self.assertEqual("twenty one", engines["en_GB"].render("21"))
+		finally:
+			shutil.rmtree(tmpDir)
+
+	def testRuleEnginePreload(self):
+		eng = RuleEngine.fromLangFilename("config/en_GB.lang")
+		eng.preload(["21", "1234567", "100"])
+		self.assertEqual(["100", "21"], sorted(eng.preloaded))
+		self.assertEqual(["twenty", "one"], eng.resolve("21"))
+		self.assertEqual("one hundred", eng.render("100"))
+
+		## The memory cap stops preloading early
+		eng = RuleEngine.fromLangFilename("config/en_GB.lang")
+		eng.preload([str(x) for x in range(1000)], maxBytes=5000)
+		self.assertTrue(0 < len(eng.preloaded) < 1000)
+		self.assertTrue(eng.preloadedBytes <= 5000)
+
+		eng = RuleEngine.fromLangFilename("config/en_GB.lang")
+		eng.preload(["1", "2"], background=True).join()
+		self.assertEqual(2, len(eng.preloaded))
+
+	def testResolutionBudget(self):
+		eng = RuleEngine.fromLangFilename("config/en_GB.lang")
+		eng.setBudget(ResolutionBudget(maxInputLength=9))
+		self.assertEqual(["twenty", "one"], eng.resolve("21"))
+		self.assertRaises(RuleUsageException, eng.resolve, "2x1")
+		self.assertRaises(RuleUsageException, eng.resolve, "12\n")
+		self.assertRaises(RuleUsageException, eng.render, "")
+		self.assertRaises(RuleBudgetException, eng.resolve, "1" * 10)
+		self.assertEqual((3, 1), (eng.inputsRejected, eng.budgetsExceeded))
+
+		## Budget failures are also RuleEvaluationExceptions
+		eng.setBudget(ResolutionBudget(maxRecursionSteps=2))
+		self.assertEqual("twenty-one", eng.render("21").replace(" ", "-"))
+		self.assertRaises(RuleEvaluationException, eng.resolve, "123456")
+		eng.setBudget(ResolutionBudget(maxRulesScanned=1))
+		self.assertRaises(RuleBudgetException, eng.resolve, "21")
+		eng.setBudget(ResolutionBudget(deadline=-1))
+		self.assertRaises(RuleBudgetException, eng.resolve, "21")
+		self.assertEqual(4, eng.budgetsExceeded)
+
+		## Without a budget, values of lengths no rule accepts fail fast
+		eng.setBudget(None)
+		self.assertEqual(None, eng.resolve("1" * 40))
+
+		## Bulk resolution reports budget failures by offset
+		eng.setBudget(ResolutionBudget(maxInputLength=3))
+		out = io.BytesIO()
+		result = eng.resolveBuffer(b"21\n12345\n7\n", out)
+		self.assertEqual(b"twenty,one\n\nseven\n", out.getvalue())
+		self.assertEqual(3, result.errors[0][0])
+
+	def testLangOverlay(self):
+		loader = LangLoader("config")
+		fr = loader.load("fr_FR")
+		be = loader.load("fr_BE")
+		self.assertTrue(be.base is fr)
+		self.assertEqual("septante et un", be.render("71"))
+		self.assertEqual("cent nonante-neuf", be.render("199"))
+		self.assertEqual("soixante-cinq", be.render("65"))
+		self.assertEqual(["septante", "deux"], be.resolve("72"))
+		self.assertEqual("huitante-cinq", loader.load("fr_CH").render("85"))
+		self.assertEqual("-", be.ruleList.directives["joiner"])
+
+		## Unchanged rules, their plans and fragment results are shared
+		self.assertEqual(len(fr.ruleList) + 2, len(be.ruleList))
+		self.assertEqual(6, len(set(be.ruleList.rules) - set(fr.ruleList.rules)))
+		rule = [r for r in fr.ruleList.rules if r.lhs == "1000"][0]
+		self.assertTrue(be.plans[rule] is fr.plans[rule])
+		self.assertTrue(be.fragments["12"] is fr.fragments["12"])
+		self.assertFalse(be.fragments.get("70") is fr.fragments.get("70"))
+
+		## So are the base's index and recursion checks, giving the same results
+		## as analysing the flattened rule list
+		self.assertTrue(be.ruleGraph.index.baseIndex is fr.ruleGraph.index)
+		rule = [r for r in fr.ruleList.rules if r.lhs == "T000"][0]
+		self.assertTrue(be.ruleGraph.edges[rule] is fr.ruleGraph.edges[rule])
+		graph = RuleGraph(be.ruleList)
+		for r in be.ruleList.rules:
+			self.assertEqual(graph.edges[r], be.ruleGraph.edges[r])
+		for state in ["?", "7?", "?1", "???", "??????"]:
+			self.assertEqual(graph.index.matching(state), be.ruleGraph.index.matching(state))
+			self.assertEqual(graph.candidates(state), be.ruleGraph.candidates(state))
+		for value in [str(x) for x in range(0, 200000, 37)]:
+			self.assertEqual(graph.index.first(value), be.ruleGraph.index.first(value))
+
+		## Overlays resolve as their flattened rule list would
+		flat = RuleEngine(be.ruleList, False)
+		for value in [str(x) for x in range(0, 200000, 37)]:
+			self.assertEqual(flat.resolve(value), be.resolve(value))
+
+		tmpDir = tempfile.mkdtemp()
+		try:
+			def writeLang(locale, text):
+				f = open(os.path.join(tmpDir, locale + ".lang"), "w")
+				f.write(text)
+				f.close()
+				return os.path.join(tmpDir, locale + ".lang")
+			writeLang("base", "@joiner=\"-\"\n1=one\nu=unit\n")
+			## Overrides keep their place; new rules follow the rule listed before
+			## them, or are searched before base rules if listed first
+			eng = RuleEngine.fromLangFilename(writeLang("over", 
+				"@base=base\n@separator=\"_\"\n2=two\nu=other\n9=nine\n1=uno\n"))
+			self.assertEqual(["2", "1", "u", "9"], [r.lhs for r in eng.ruleList.rules])
+			self.assertEqual(["uno", "two", "other"], 
+				[eng.render(v) for v in ["1", "2", "3"]])
+			self.assertEqual({"separator": "_", "joiner": "-"}, eng.ruleList.directives)
+
+			writeLang("a", "@base=b\n1=one\n")
+			writeLang("b", "@base=a\n1=one\n")
+			self.assertRaises(RuleValidationException, LangLoader(tmpDir).load, "a")
+			self.assertEqual([(1, 1)], [(e.lineNumber, e.column) 
+				for e in checkLangFile(writeLang("c", "@base=missing\n1=one\n"))])
+			self.assertEqual([3], [e.lineNumber for e in checkLangFile(
+				writeLang("d", "@base=base\n1=one\n2=($2)\n"))])
+			self.assertEqual([(1, 7)], [(e.lineNumber, e.column) 
+				for e in checkLangFile(writeLang("e", "@base=../x\n"))])
+		finally:
+			shutil.rmtree(tmpDir)
+
+	def testRangeAggregate(self):
+		## 1-9 and 10-99: digits 1-9 (bits 1 to 9), then any digit
+		self.assertEqual([(0x3FE,), (0x3FE, 0x3FF)], rangePatterns(1, 100))
+		self.assertEqual(sum([patternSize(p) for p in rangePatterns(37, 12345)]), 12345 - 37)
+
+		for locale in ["en_GB", "fr_FR", "de_DE"]:
+			eng = RuleEngine.fromLangFilename("config/" + locale + ".lang")
+			for start, stop in [(0, 121), (95, 2345), (9990, 10011)]:
+				aggregate = eng.aggregate(start, stop)
+				tokenCounts = {}
+				characters = 0
+				for value in range(start, stop):
+					for token in eng.resolve(str(value)):
+						tokenCounts[token] = tokenCounts.get(token, 0) + 1
+					characters = characters + len(eng.render(str(value)))
+				self.assertEqual(stop - start, aggregate.count)
+				self.assertEqual(tokenCounts, aggregate.tokenCounts)
+				self.assertEqual(sum(tokenCounts.values()), aggregate.totalTokens())
+				self.assertEqual(characters, aggregate.totalCharacters())
+
+		## Values no rule matches are counted, not resolved
+		aggregate = eng.aggregate(999990, 10 ** 9)
+		self.assertEqual((10, 10 ** 9 - 10 ** 6), (aggregate.count, aggregate.unresolved))
+
+		eng = RuleEngine.fromLangFilename("config/en_GB.lang")
+		clips = dict([(token, 0.5) for token in eng.aggregate(0, 1000).tokenCounts])
+		self.assertEqual(0.5 * eng.aggregate(0, 1000).totalTokens(), 
+			eng.aggregate(0, 1000).totalDuration(clips))
+		self.assertRaises(RuleUsageException, eng.aggregate(1000, 1001).totalDuration, {})
+
+		## Fragments which cannot be resolved make the aggregate fail
+		ruleList = RuleList()
+		for rule in ["u=unit", "2u=twenty,($u)", "3u=thirty,($u0)"]:
+			ruleList.add(validateAndParseRule(rule))
+		eng = RuleEngine(ruleList)
+		self.assertEqual({"twenty": 10, "unit": 10}, eng.aggregate(20, 30).tokenCounts)
+		self.assertEqual({"thirty": 1, "twenty": 1, "unit": 1}, eng.aggregate(32, 33).tokenCounts)
+		self.assertRaises(RuleEvaluationException, eng.aggregate, 30, 31)
+
+		## As do cycles of fragments (12 -> 22 -> 21 -> 11 -> 12)
+		eng = RuleEngine(LangParser().parseLines(["1u=($u2)\n", "2u=($u1)\n"]))
+		self.assertRaises(RuleEvaluationException, eng.aggregate, 12, 13)
 
 if __name__ == '__main__':
 	unittest.main()
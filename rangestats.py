@@ -0,0 +1,41 @@
+from naturalnum import *
+import json
+import sys
+
+def rangestats():
+	"""Prints totals over every value in range(start, stop) for a locale, 
+		computed from its rules without resolving each value (see 
+		RuleEngine.aggregate).  With --clips, a JSON file of seconds per token,
+		also prints the total audio duration.
+	"""
+	args = sys.argv[1:]
+	clipLengths = None
+	if len(args) == 6 and args[0] == "--clips":
+		f = open(args[1], 'r')
+		clipLengths = json.load(f)
+		f.close()
+		args = args[2:]
+	if len(args) != 4:
+		usage()
+		return 2
+	locale = args[0]
+	start = int(args[1])
+	stop = int(args[2])
+	eng = RuleEngine.fromLangFilename("config/" + locale + ".lang")
+	aggregate = eng.aggregate(start, stop)
+	print("values: " + str(aggregate.count) + " resolved, " + 
+		str(aggregate.unresolved) + " matching no rule")
+	print("tokens: " + str(aggregate.totalTokens()))
+	print("characters: " + str(aggregate.totalCharacters()))
+	if clipLengths != None:
+		print("duration: " + "%.1f" % aggregate.totalDuration(clipLengths) + "s")
+	counts = sorted(aggregate.tokenCounts.items(), key=lambda item: (-item[1], item[0]))
+	for token, count in counts[0:int(args[3])]:
+		print("  " + token + ": " + str(count))
+	return 0
+
+def usage():
+	print("Usage: rangestats.py [--clips <json file>] <locale code> <start> <stop> <top n tokens>")
+
+if __name__ == '__main__':
+	sys.exit(rangestats())
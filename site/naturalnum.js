@@ -0,0 +1,95 @@
+/* Evaluates NaturalNum rule tables exported by exportrules.py (see
+   RuleEngine.exportTable in naturalnum.py), giving the same results as the
+   Python RuleEngine.resolve() and render(), without a server round trip. */
+
+var NATURALNUM_FORMAT_VERSION = 1;
+var NATURALNUM_MAX_DEPTH = 100;
+
+function NaturalNum(table) {
+	if (table.format != 'naturalnum-rules' || table.version != NATURALNUM_FORMAT_VERSION) {
+		throw new Error('Unsupported rule table version: ' + table.version);
+	}
+	this.table = table;
+	this.delimiters = {',': table.separator, '+': table.joiner};
+
+	// Index rules by lhs length, keeping search order within each length
+	this.rulesByLength = {};
+	for (var i = 0; i < table.rules.length; i++) {
+		var rule = table.rules[i];
+		if (!this.rulesByLength[rule.lhs.length]) {
+			this.rulesByLength[rule.lhs.length] = [];
+		}
+		this.rulesByLength[rule.lhs.length].push(rule);
+	}
+}
+
+// Returns the first matching rule and the digits bound to its digivars, or null
+NaturalNum.prototype.search = function(value) {
+	var rules = this.rulesByLength[value.length] || [];
+	for (var i = 0; i < rules.length; i++) {
+		var lhs = rules[i].lhs;
+		var groups = [];
+		var matched = true;
+		for (var j = 0; j < lhs.length; j++) {
+			var c = lhs.charAt(j);
+			if (c >= '0' && c <= '9') {
+				if (c != value.charAt(j)) {
+					matched = false;
+					break;
+				}
+			} else {
+				groups.push(value.charAt(j));
+			}
+		}
+		if (matched) {
+			return {rule: rules[i], groups: groups};
+		}
+	}
+	return null;
+};
+
+NaturalNum.prototype.resolveInto = function(value, tokens, parts, depth) {
+	if (depth > NATURALNUM_MAX_DEPTH) {
+		throw new Error('Recursion too deep resolving [' + value + ']');
+	}
+	var found = this.search(value);
+	if (found == null) {
+		return false;
+	}
+	var rule = found.rule;
+	for (var i = 0; i < rule.tokens.length; i++) {
+		if (i > 0) {
+			parts.push(this.delimiters[rule.delimiters[i - 1]]);
+		}
+		var template = rule.tokens[i].template;
+		var expanded = '';
+		for (var j = 0; j < template.length; j++) {
+			expanded += (typeof template[j] == 'number') ? found.groups[template[j]] : template[j];
+		}
+		if (rule.tokens[i].recurse) {
+			if (!this.resolveInto(expanded, tokens, parts, depth + 1)) {
+				throw new Error('Could not match fragment of result [' + expanded + '] to a rule');
+			}
+		} else {
+			tokens.push(expanded);
+			parts.push(expanded);
+		}
+	}
+	return true;
+};
+
+// Returns the list of tokens for value, or null if no rule matches
+NaturalNum.prototype.resolve = function(value) {
+	var tokens = [];
+	return this.resolveInto(value, tokens, [], 0) ? tokens : null;
+};
+
+// Returns the rendered string for value, or null if no rule matches
+NaturalNum.prototype.render = function(value) {
+	var parts = [];
+	return this.resolveInto(value, [], parts, 0) ? parts.join('') : null;
+};
+
+if (typeof module != 'undefined') {
+	module.exports = NaturalNum;
+}
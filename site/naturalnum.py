@@ -1,10 +1,49 @@
+""" Subset of naturalnum.py served by nnjson.py: loading .lang files and
+resolving values within a ResolutionBudget.  The App Engine runtime is 
+Python 2.5, so this module avoids later syntax and modules; keep it in step
+with naturalnum.py (the tests check it gives the same results).
+"""
 import re
+import os
+import sys
+import time
 import logging
 
 lhsValidatorRegex = r"[0-9a-zA-Z]+"
-rhsValidatorRegex = r"[0-9a-zA-Z\(\),\$-]+"  ## Only alphanumerics (inc. hyphen) or these chars: (),$
+rhsValidatorRegex = r"[0-9a-zA-Z\(\),\$+-]+" ## Only alphanumerics (inc. hyphen) or these chars: (),$+
 ruleValidatorRegex = r".+=.+"               ## At least one char each side of '=' delimiter
 rhsPlaceholderRegex = r"\$[A-Za-z]"         ## A '$' followed by an alpha char
+rhsDelimiterRegex = r"([,+])"               ## ',' separates words, '+' joins within a word
+directiveValidatorRegex = r"@([a-z]+)=(.*)$" ## '@' directive name, '=', then value
+
+## Patterns used when validating rules, compiled once rather than per rule
+rhsPlaceholderPattern = re.compile(rhsPlaceholderRegex)
+rhsBadPlaceholderPattern = re.compile(r"\$(?![A-Za-z])")   ## A '$' not followed by an alpha char
+withinBracketsPattern = re.compile(r"\(.*?\)")
+digitsOrDigivarsPattern = re.compile(r"^(\$[a-zA-Z]|[0-9])+$")
+rhsDelimiterPattern = re.compile(rhsDelimiterRegex)
+backrefPattern = re.compile(r"\\g<([0-9]+)>")
+
+## Kinds of step in a RuleEngine's plan for a rule's rhs tokens
+tokenLiteral = 0    ## Expand digivars in the token and output it
+tokenRecurse = 1    ## Expand digivars and feed the result back through the engine
+
+## Resolving a value recursing deeper than this raises RuleEvaluationException
+resolveMaxDepth = 100
+
+## Rendering directives which may be declared in a .lang file, with defaults
+directiveDefaults = {"separator": " ", "joiner": ""}
+## Directive naming the locale a .lang file overlays, e.g. @base=fr_FR
+baseDirective = "base"
+localePattern = re.compile(r"[A-Za-z0-9_-]+\Z")
+
+## Values accepted by a RuleEngine with a ResolutionBudget
+valueValidatorPattern = re.compile(r"[0-9]+\Z")
+
+## Highest resolution clock available, for deadlines
+timer = getattr(time, "perf_counter", time.time)
+## Size of an object in bytes, for limiting preloading (a length before 2.6)
+sizeof = getattr(sys, "getsizeof", len)
 
 ## Set up logging (users will set up their own handlers)
 class NullHandler(logging.Handler):
@@ -24,6 +63,7 @@ class Rule:
 	def __init__(self, lhs=None, rhs=None):
 		self.lhs = lhs
 		self.rhs = rhs
+		self.lineNumber = None    ## Set when parsed from a .lang file
 
 	def init(self):
 		self.validateLhs()
@@ -46,103 +86,107 @@ class Rule:
 		# Ensure lhs is present
 		if (self.lhs == None or self.lhs == ""):
 			raise RuleValidationException("Could not validate lhs of Rule: [" + 
-				"" if self.lhs is None else self.lhs + "] because it is empty.")
+				"" if self.lhs is None else self.lhs + "] because it is empty.", 0)
 
 		# Ensure lhs is alphanumeric only
 		if (re.match(lhsValidatorRegex, self.lhs) == None):
 			raise RuleValidationException("Could not validate lhs of Rule: [" + 
-				self.lhs + "].  Only alpha/digits allowed.")
+				self.lhs + "].  Only alpha/digits allowed.", 0)
 	
 		# If alpha chars present, ensure they are unique
 		if(not self.lhs.isdigit()):
-			alphas = [x for x in self.lhs if not x.isdigit()]
-			if len(set(alphas)) != len(alphas):
-				raise RuleValidationException("Could not validate lhs of Rule: [" + 
-					self.lhs + "].  Alpha characters must be unique.")
+			seen = set()
+			for pos, x in enumerate(self.lhs):
+				if x.isdigit():
+					continue
+				if x in seen:
+					raise RuleValidationException("Could not validate lhs of Rule: [" + 
+						self.lhs + "].  Alpha characters must be unique.", pos)
+				seen.add(x)
 
 	def splitRhsTokens(self):
-		"""Splits rhs string into a list of tokens, separated by ',' delimiter"""
-		self.rhsTokenList = self.rhsWithBackrefs.split(',')
+		"""Splits rhs string into a list of tokens, separated by ',' or '+'
+			delimiters.  The delimiter between each pair of tokens is kept in
+			rhsDelimiterList, for use when rendering.
+		"""
+		tokensAndDelimiters = rhsDelimiterPattern.split(self.rhsWithBackrefs)
+		self.rhsTokenList = tokensAndDelimiters[0::2]
+		self.rhsDelimiterList = tokensAndDelimiters[1::2]
 
 	def validateRhs(self):
 		"""Validates string in RHS of a rule.  All of the following must be true:
 			- Not empty or null
-			- Only alphanumeric chars, or any of: (),$
+			- Only alphanumeric chars, or any of: (),$+
 			- Brackets must be balanced
 			- Anything within brackets should resolve to digits
 		"""
 		# Check rhs is present
 		if (self.rhs == None or self.rhs == ""):
 			raise RuleValidationException("Could not validate rhs of Rule: [" +
-				"" if self.rhs is None else self.rhs + "] because it is empty.")
-	   
-		logger.debug("Validating rhs: " + self.rhs)
+				"" if self.rhs is None else self.rhs + "] because it is empty.",
+				self.rhsColumn(0))
 	
 		# Check only allowed chars present
 		if (re.match(rhsValidatorRegex, self.rhs) == None):
 			raise RuleValidationException("Could not validate rhs of Rule: [" + 
-				self.rhs + "].  Only alpha/digits or the following chars allowed: (),$")
+				self.rhs + "].  Only alpha/digits or the following chars allowed: (),$+",
+				self.rhsColumn(0))
 	
 		# Check '$' only precedes an alpha character
-		checkNextIsAlpha = False
-		for x in self.rhs:
-			if x == '$':	
-				checkNextIsAlpha = True
-			else:
-				if checkNextIsAlpha:
-					if not x.isalpha():
-						raise RuleValidationException("Could not validate rhs of Rule: [" + 
-							self.rhs + "].  '$' must always be folowed by an alpha char.")
-					checkNextIsAlpha = False
+		match = rhsBadPlaceholderPattern.search(self.rhs)
+		if match != None:
+			raise RuleValidationException("Could not validate rhs of Rule: [" + 
+				self.rhs + "].  '$' must always be folowed by an alpha char.",
+				self.rhsColumn(match.start()))
 					
 		# Ensure everything within brackets is either digits or digivars
-		withinBracketsSearchPatt = re.compile("\\(.*?\\)")  # todo move to constant
-		for match in re.finditer(withinBracketsSearchPatt, self.rhs):
+		for match in withinBracketsPattern.finditer(self.rhs):
 			matchedVal = self.rhs[match.start()+1:match.end()-1]
-			logger.debug("Checking rhs token within brackets [" + matchedVal + "] is digits or digivars")
-			digitsOrDigivarsPatt = re.compile("^(\\$[a-zA-Z]|[0-9])+$")  # todo move to constant
-			if digitsOrDigivarsPatt.match(matchedVal) == None:
+			if digitsOrDigivarsPattern.match(matchedVal) == None:
 				raise RuleValidationException \
-					("Bracketed terms must contain only digits or digivars")
+					("Bracketed terms must contain only digits or digivars",
+					self.rhsColumn(match.start()))
+
+	def rhsColumn(self, pos):
+		"""Returns the offset of position 'pos' in the rhs, within the whole
+			rule string '<lhs>=<rhs>'.
+		"""
+		if self.lhs == None:
+			return pos
+		return len(self.lhs) + 1 + pos
 
 	def validateRhsTokenList(self):
 		""""""
-		# Check that if brackets exist, they are at the start/end positions
-		
-		for token in self.rhsTokenList:
-			pos = 0
-			for x in token:
-				if x == '(' and not pos == 0: 				
-					raise RuleValidationException("Could not validate rhs token: [" + 
-						token + "] - can only start recursion at beginning of token.")
-				elif x == ')' and not pos == len(token)-1:
-					raise RuleValidationException("Could not validate rhs token: [" + 
-						token + "] - can only end recursion at end of token.")
-				pos = pos + 1
+		# Check that if brackets exist, they are at the start/end positions.
+		# Tokens are taken from the rhs as written (rather than rhsTokenList, 
+		# which holds backreferences) so that error positions match the rule.
+		offset = 0
+		for token in rhsDelimiterPattern.split(self.rhs)[0::2]:
+			pos = token.find('(', 1)
+			if pos != -1:
+				raise RuleValidationException("Could not validate rhs token: [" + 
+					token + "] - can only start recursion at beginning of token.",
+					self.rhsColumn(offset + pos))
+			pos = token.find(')', 0, len(token) - 1)
+			if pos != -1:
+				raise RuleValidationException("Could not validate rhs token: [" + 
+					token + "] - can only end recursion at end of token.",
+					self.rhsColumn(offset + pos))
+			offset = offset + len(token) + 1
 
 	def validateLhsWithRhs(self):
 		# Check all placeholders on RHS appear on LHS
 		# 1. Find set of all LHS placeholders
 		lhsPlaceholders = set([x for x in self.lhs if not x.isdigit()])
 
-		# 2. Find set of all RHS placeholders
-		placeholderDetected = False
-		rhsPlaceholdersList = []	
-		for x in self.rhs:
-			if x == '$':
-				placeholderDetected = True
-			else:
-				if placeholderDetected:
-					rhsPlaceholdersList.append(x)
-					placeholderDetected = False
-		rhsPlaceholders = set(rhsPlaceholdersList)
-	
-		# 3. Check RHS placeholders is a subset of LHS placeholders 
+		# 2. Check each RHS placeholder appears on the LHS 
 		# (not necessarily vice-versa)
-		if not rhsPlaceholders <= lhsPlaceholders:
-			raise RuleValidationException("Could not validate Rule lhs [" + 
-				self.lhs + "] with rhs: [" + self.rhs + 
-				"] - placeholder(s) on rhs do not appear on lhs.")
+		for match in rhsPlaceholderPattern.finditer(self.rhs):
+			if self.rhs[match.start()+1] not in lhsPlaceholders:
+				raise RuleValidationException("Could not validate Rule lhs [" + 
+					self.lhs + "] with rhs: [" + self.rhs + 
+					"] - placeholder(s) on rhs do not appear on lhs.",
+					self.rhsColumn(match.start()))
 		
 	def buildLhsRegex(self):
 		lhsRegex = "^"
@@ -194,9 +238,8 @@ class Rule:
 		## Replace all instances of "$<char>" in rhs expression with a 
 		## backreference to the group number matching that char in the LHS regex.
 		rhsWithBackrefs = self.rhs
-		rhsPlaceholderSearchPatt = re.compile(rhsPlaceholderRegex)
 
-		for match in re.finditer(rhsPlaceholderSearchPatt, self.rhs):
+		for match in rhsPlaceholderPattern.finditer(self.rhs):
 			matchedVal = self.rhs[match.start():match.end()]
 			backref = "\\g<" + str(self.lhsGroupDict[matchedVal[1:]]) + ">"
 			rhsWithBackrefs = rhsWithBackrefs.replace(matchedVal, backref)
@@ -211,8 +254,8 @@ class Rule:
 			raise RuleUsageException("Rule does not match value, cannot resolve")
 		tokenList = []
 		for rhsToken in self.rhsTokenList:
-			#logger.debug("replacing [" + value + "] with [" + rhsToken + \
-			#	"] in context of match regex [" + self.lhsRegex + "]")
+			logger.debug("replacing [" + value + "] with [" + rhsToken + \
+				"] in context of match regex [" + self.lhsRegex + "]")
 			resolvedRhsToken = self.lhsRegexPattern.sub(rhsToken, value)
 			tokenList.append(resolvedRhsToken)
 		return tokenList
@@ -221,8 +264,9 @@ class Rule:
 		return "[" + self.lhs + "=" + self.rhs + "], [" + self.lhsRegex + "=" + self.rhsWithBackrefs + "]"
 
 class RuleValidationException(Exception):
-	def __init__(self, value):
+	def __init__(self, value, column=None):
 		self.value = value
+		self.column = column    ## Offset of the error within the rule, if known
 	def __str__(self):
 		return repr(self.value)
 
@@ -238,9 +282,16 @@ class RuleEvaluationException(Exception):
 	def __str__(self):
 		return repr(self.value)
 
+class RuleBudgetException(RuleEvaluationException):
+	"""Raised when resolving a value exceeds the engine's ResolutionBudget."""
+	pass
+
 class RuleList:
 	def __init__(self):
 		self.rules = []
+		self.directives = dict(directiveDefaults)
+		self.declaredDirectives = set()
+		self.base = None
 		
 	def __len__(self):
 		return len(self.rules)
@@ -248,6 +299,43 @@ class RuleList:
 	def add(self, rule):
 		self.rules.append(rule)
 
+	def setDirective(self, name, value):
+		self.directives[name] = value
+		self.declaredDirectives.add(name)
+
+	def inherit(self, base):
+		"""Makes this rule list an overlay on the RuleList 'base', sharing its
+			Rule objects.  A rule with the same lhs as a base rule replaces it,
+			in the base rule's place in search order.  Other rules keep their
+			order relative to those: each is searched straight after the rule
+			listed before it, or before all base rules if listed first.  So an
+			overlay may add a general rule (e.g. 7u) after its own exceptions
+			(e.g. 70, 71) without shadowing them.  Directives not declared 
+			here are taken from the base.
+		"""
+		baseLhs = set([rule.lhs for rule in base.rules])
+		overrides = {}
+		leading = []
+		following = {}    ## Added rules by the lhs of the override before them
+		previous = None
+		for rule in self.rules:
+			if rule.lhs in baseLhs:
+				if rule.lhs not in overrides:
+					overrides[rule.lhs] = rule
+				previous = rule.lhs
+			elif previous == None:
+				leading.append(rule)
+			else:
+				following.setdefault(previous, []).append(rule)
+		self.rules = leading
+		for rule in base.rules:
+			self.rules.append(overrides.get(rule.lhs, rule))
+			self.rules.extend(following.pop(rule.lhs, []))
+		for name in base.directives:
+			if name not in self.declaredDirectives:
+				self.directives[name] = base.directives[name]
+		self.base = base
+
 	def search(self, value):
 		for rule in self.rules:
 			if rule.matches(value):
@@ -256,51 +344,465 @@ class RuleList:
 class RuleEngine:
 	def __init__(self, ruleList):
 		self.ruleList = ruleList
+		self.maxDepth = resolveMaxDepth
+		self.budget = None
+		self.inputsRejected = 0
+		self.budgetsExceeded = 0
+		self.preloaded = {}
+		self.preloadedBytes = 0
+		self.compile()
+
+	def compile(self):
+		"""Prepares the engine for resolving values against its rule list.  This
+			must be called again if the rule list is modified.
+		"""
+		self.renderDelimiters = {
+			",": self.ruleList.directives["separator"],
+			"+": self.ruleList.directives["joiner"]}
+		self.ruleIndex = RuleIndex(self.ruleList.rules)
+		self.lhsLengths = set([len(rule.lhs) for rule in self.ruleList.rules])
+		self.plans = {}
+		for rule in self.ruleList.rules:
+			self.plans[rule] = self.buildPlan(rule)
+
+	def buildPlan(self, rule):
+		plan = []
+		for rhsToken in rule.rhsTokenList:
+			if rhsToken[0:1] == '(' and rhsToken[-1:] == ')':
+				plan.append((tokenRecurse, compileTemplate(rhsToken[1:-1])))
+			else:
+				plan.append((tokenLiteral, compileTemplate(rhsToken)))
+		return plan
 
 	@classmethod
 	def fromLangFilename(cls, fileName):
-		logger.debug("fromLangFilename()")
-		f = open(fileName, 'r')
-		logger.debug("opened config file [" + fileName + "]")
-		ruleList = RuleList()
-		for line in f:
-			logger.debug("read line: [" + line[0:-1] + "]")
-			rule = validateAndParseRule(line)
-			if rule != None:
-				logger.debug("Adding Rule to RuleList")
-				ruleList.add(rule)
-			else:
-				logger.debug("No rule found, skipping this line")
-		re = RuleEngine(ruleList)
-		logger.debug("finished loading RuleEngine")
-		return re
+		"""Loads a RuleEngine from a .lang file.  If the file declares a base
+			locale (e.g. @base=fr_FR), the base is loaded from the same 
+			directory (see LangLoader).
+		"""
+		loader = LangLoader(os.path.dirname(fileName))
+		return loader.load(os.path.splitext(os.path.basename(fileName))[0], fileName)
+
+	def setBudget(self, budget):
+		"""Limits the work done by each resolve()/render() call, according to a
+			ResolutionBudget (None for no limits).  With a budget set, values 
+			which are not digits-only are rejected with RuleUsageException 
+			before any rule is scanned, and exceeding any limit raises 
+			RuleBudgetException.  Both are counted (inputsRejected and 
+			budgetsExceeded).
+		"""
+		self.budget = budget
+
+	def checkValue(self, value):
+		"""Applies the budget's checks on an input value, returning a new 
+			BudgetTracker for resolving it, or None if there is no budget.
+		"""
+		if self.budget == None:
+			return None
+		if valueValidatorPattern.match(value) == None:
+			self.inputsRejected = self.inputsRejected + 1
+			raise RuleUsageException("Could not resolve [" + value[0:32] + 
+				"]: only digits are allowed")
+		tracker = BudgetTracker(self.budget)
+		try:
+			tracker.checkLength(value)
+		except RuleBudgetException:
+			self.budgetsExceeded = self.budgetsExceeded + 1
+			raise
+		return tracker
+
+	def resolveWithin(self, value, tokens, parts, tracker):
+		"""resolveInto() for a top-level value, within the budget (if any)."""
+		if len(value) not in self.lhsLengths:
+			return False
+		if tracker == None:
+			return self.resolveInto(value, tokens, parts)
+		try:
+			return self.resolveInto(value, tokens, parts, 0, tracker)
+		except RuleBudgetException:
+			self.budgetsExceeded = self.budgetsExceeded + 1
+			raise
 
 	def resolve(self, value):
 		logger.debug("resolve() value=[" + value + "]")
-		matchedRule = self.ruleList.search(value)
-		if not matchedRule == None:
-			logger.debug("found matched rule: " + str(matchedRule))
-			rhsTokens = matchedRule.resolve(value)
-			rhsTokensFollowingRecursion = []
-			for rhsToken in rhsTokens:
-				## If current rhs token is enclosed in brackets, replace it with
-				## the result of feeding the value (without brackets) back through
-				## the rule engine.
-				if rhsToken[0:1] == '(' and rhsToken[-1:] == ')':
-					rhsTokenToRecurse = rhsToken[1:-1]
-					logger.debug("Recursing value [" + rhsTokenToRecurse + "] back through rule engine")
-					resultAfterRecursion = self.resolve(rhsTokenToRecurse)
-					if resultAfterRecursion == None:
-						raise RuleEvaluationException("Could not match fragment of result [" + \
-							rhsTokenToRecurse + "] to a rule")	
-					rhsTokensFollowingRecursion = rhsTokensFollowingRecursion + \
-						resultAfterRecursion
-				else:
-					rhsTokensFollowingRecursion.append(rhsToken)					
-			return rhsTokensFollowingRecursion
-		else:
+		tracker = self.checkValue(value)
+		preloaded = self.preloaded.get(value)
+		if preloaded != None:
+			return list(preloaded[0])
+		tokens = []
+		if not self.resolveWithin(value, tokens, None, tracker):
 			logger.debug("could not find matching rule")
 			return None
+		return tokens
+
+	def render(self, value):
+		"""Resolves 'value' straight to its final string, joining tokens with
+			the locale's separator (',' in rules) or joiner ('+' in rules).
+			Returns None if no rule matches.
+		"""
+		tracker = self.checkValue(value)
+		preloaded = self.preloaded.get(value)
+		if preloaded != None:
+			return preloaded[1]
+		parts = []
+		if not self.resolveWithin(value, None, parts, tracker):
+			return None
+		return "".join(parts)
+
+	def preload(self, values, maxBytes=None):
+		"""Resolves 'values' (e.g. the most frequent first, from a warm set -
+			see readWarmSet) in advance, so resolve() and render() serve them 
+			from memory.  Stops once the estimated size of preloaded results 
+			exceeds 'maxBytes', if given.
+		"""
+		for value in values:
+			if value in self.preloaded:
+				continue
+			tokens = []
+			parts = []
+			try:
+				if not self.resolveInto(value, tokens, parts):
+					continue
+			except (RuleEvaluationException, RuntimeError):
+				continue
+			result = (tokens, "".join(parts))
+			size = (sizeof(value) + sizeof(tokens) + sizeof(result[1]) + 
+				sum([sizeof(t) for t in tokens]))
+			if maxBytes != None and self.preloadedBytes + size > maxBytes:
+				break
+			self.preloaded[value] = result
+			self.preloadedBytes = self.preloadedBytes + size
+
+	def resolveInto(self, value, tokens, parts, depth=0, tracker=None):
+		"""Resolves 'value', appending its tokens to the list 'tokens' and its
+			rendered fragments to the list 'parts' (either may be None).  
+			Returns False if no rule matches 'value'.  Each step is charged to
+			'tracker', if given.
+		"""
+		if self.maxDepth != None and depth > self.maxDepth:
+			raise RuleEvaluationException("Recursion deeper than " + 
+				str(self.maxDepth) + " resolving [" + value + "]")
+		index = self.ruleIndex.first(value)
+		if tracker != None:
+			tracker.step(value)
+			tracker.scanned(len(self.ruleList) if index == -1 else index + 1)
+		if index == -1:
+			return False
+		matchedRule = self.ruleList.rules[index]
+		groups = matchedRule.lhsRegexPattern.match(value).groups()
+		delimiters = matchedRule.rhsDelimiterList
+		for i, (kind, template) in enumerate(self.plans[matchedRule]):
+			if parts is not None and i > 0:
+				parts.append(self.renderDelimiters[delimiters[i - 1]])
+			rhsToken = expandTemplate(template, groups)
+			if kind == tokenLiteral:
+				if tokens is not None:
+					tokens.append(rhsToken)
+				if parts is not None:
+					parts.append(rhsToken)
+			elif not self.resolveInto(rhsToken, tokens, parts, depth + 1, tracker):
+				raise RuleEvaluationException("Could not match fragment of result [" + \
+					rhsToken + "] to a rule")
+		return True
+
+class RuleIndex:
+	"""Finds the rules which may match a value without testing every rule.
+		Rules are held in a trie by lhs, in which every digivar is the same 
+		'?' branch.
+	"""
+
+	def __init__(self, rules):
+		self.root = {}
+		for i, rule in enumerate(rules):
+			node = self.root
+			for c in rule.lhs:
+				node = node.setdefault(c if c.isdigit() else '?', {})
+			node.setdefault(None, []).append(i)
+
+	def matching(self, state):
+		"""Returns the indexes, in search order, of the rules which may match 
+			some value represented by 'state' (see RuleGraph), in which '?' 
+			stands for any digit.
+		"""
+		found = []
+		self.collect(self.root, state, 0, True, found)
+		found.sort()
+		return found
+
+	def first(self, value):
+		"""Returns the index of the first rule matching 'value', or -1."""
+		found = []
+		self.collect(self.root, value, 0, False, found)
+		if not found:
+			return -1
+		return min(found)
+
+	def collect(self, node, state, pos, wildcards, found):
+		if pos == len(state):
+			found.extend(node.get(None, ()))
+			return
+		c = state[pos]
+		if wildcards and c == '?':
+			for key, child in node.items():
+				if key != None:
+					self.collect(child, state, pos + 1, wildcards, found)
+			return
+		child = node.get(c)
+		if child != None and c != '?':
+			self.collect(child, state, pos + 1, wildcards, found)
+		## A digivar matches any character but a newline, as in lhsRegex
+		child = node.get('?')
+		if child != None and c != '\n':
+			self.collect(child, state, pos + 1, wildcards, found)
+
+class ResolutionBudget:
+	"""Limits on the work done resolving one value (see RuleEngine.setBudget).
+		Any limit may be None for no limit.
+		- maxInputLength: maximum number of digits in the value
+		- maxRulesScanned: maximum rules searched, in search order, up to the
+		  match for each value and fragment, in total
+		- maxRecursionSteps: maximum values and fragments resolved, in total
+		- deadline: maximum wall-clock seconds
+	"""
+
+	def __init__(self, maxInputLength=None, maxRulesScanned=None, 
+			maxRecursionSteps=None, deadline=None):
+		self.maxInputLength = maxInputLength
+		self.maxRulesScanned = maxRulesScanned
+		self.maxRecursionSteps = maxRecursionSteps
+		self.deadline = deadline
+
+class BudgetTracker:
+	"""Work done so far resolving one value, against a ResolutionBudget."""
+
+	def __init__(self, budget):
+		self.budget = budget
+		self.rulesScanned = 0
+		self.recursionSteps = 0
+		self.expires = None
+		if budget.deadline != None:
+			self.expires = timer() + budget.deadline
+
+	def checkLength(self, value):
+		if self.budget.maxInputLength != None and len(value) > self.budget.maxInputLength:
+			raise RuleBudgetException("Could not resolve value of " + str(len(value)) + 
+				" digits: maximum is " + str(self.budget.maxInputLength))
+
+	def step(self, value):
+		self.recursionSteps = self.recursionSteps + 1
+		if (self.budget.maxRecursionSteps != None and 
+				self.recursionSteps > self.budget.maxRecursionSteps):
+			raise RuleBudgetException("Exceeded " + str(self.budget.maxRecursionSteps) + 
+				" recursion steps resolving [" + value + "]")
+		if self.expires != None and timer() > self.expires:
+			raise RuleBudgetException("Exceeded deadline of " + str(self.budget.deadline) + 
+				" seconds resolving [" + value + "]")
+
+	def scanned(self, count):
+		self.rulesScanned = self.rulesScanned + count
+		if (self.budget.maxRulesScanned != None and 
+				self.rulesScanned > self.budget.maxRulesScanned):
+			raise RuleBudgetException("Exceeded " + str(self.budget.maxRulesScanned) + 
+				" rules scanned")
+
+class LangParser:
+	"""Parses a .lang file into a RuleList in a single pass, collecting every
+		validation error (with line and column numbers) as a LangFileError 
+		rather than stopping at the first.
+	"""
+
+	def __init__(self, fileName=None):
+		self.fileName = fileName
+		self.ruleList = RuleList()
+		self.errors = []
+		self.base = None              ## Base locale, if declared
+		self.baseLineNumber = None
+
+	def parseFile(self):
+		f = open(self.fileName, 'r')
+		try:
+			return self.parseLines(f)
+		finally:
+			f.close()
+
+	def parseLines(self, lines):
+		lineNumber = 0
+		for line in lines:
+			lineNumber = lineNumber + 1
+			self.parseLine(line, lineNumber)
+		logger.debug("parsed " + str(lineNumber) + " lines, " + 
+			str(len(self.ruleList)) + " rules, " + str(len(self.errors)) + " errors")
+		return self.ruleList
+
+	def parseLine(self, line, lineNumber):
+		try:
+			directive = validateAndParseDirective(line)
+			if directive != None and directive[0] == baseDirective:
+				if localePattern.match(directive[1]) == None:
+					raise RuleValidationException("Could not validate base locale: [" +
+						directive[1] + "]", line.find("=") + 1)
+				self.base = directive[1]
+				self.baseLineNumber = lineNumber
+				return
+			if directive != None:
+				self.ruleList.setDirective(directive[0], directive[1])
+				return
+			rule = validateAndParseRule(line)
+			if rule != None:
+				rule.lineNumber = lineNumber
+				self.ruleList.add(rule)
+		except RuleValidationException:
+			e = sys.exc_info()[1]
+			column = 1 if e.column == None else e.column + 1
+			self.errors.append(LangFileError(self.fileName, lineNumber, column, e.value))
+
+class LangFileError:
+	"""A validation error at a (1-based) line and column of a .lang file."""
+
+	def __init__(self, fileName, lineNumber, column, message):
+		self.fileName = fileName
+		self.lineNumber = lineNumber
+		self.column = column
+		self.message = message
+
+	def __str__(self):
+		return (str(self.fileName) + ":" + str(self.lineNumber) + ":" + 
+			str(self.column) + ": " + self.message)
+
+class LangLoader:
+	"""Loads RuleEngines for the .lang files in a directory, by locale (the 
+		file name without '.lang').  A file may declare a base locale, e.g.:
+		@base=fr_FR
+		and then only override or add rules (see RuleList.inherit).  Each 
+		locale is loaded once, so all overlays on a base share its Rule 
+		objects.
+
+		If 'warmSetFileName' names a warm set (see warmset.py), each engine
+		preloads its locale's values from it, up to 'warmMaxBytes' each (see
+		RuleEngine.preload).
+	"""
+
+	def __init__(self, path, warmSetFileName=None, warmMaxBytes=None):
+		self.path = path
+		self.warmSetFileName = warmSetFileName
+		self.warmMaxBytes = warmMaxBytes
+		self.warmSet = None
+		self.engines = {}
+		self.loading = []
+
+	def load(self, locale, fileName=None):
+		"""Returns the RuleEngine for 'locale', loading it (and its bases) if
+			necessary.
+		"""
+		if locale in self.engines:
+			return self.engines[locale]
+		if locale in self.loading:
+			raise RuleValidationException("Base locales form a cycle: " + 
+				" -> ".join(self.loading + [locale]))
+		if fileName == None:
+			fileName = os.path.join(self.path, locale + ".lang")
+		if not os.path.exists(fileName):
+			raise RuleValidationException("Could not load [" + fileName + 
+				"]: file not found")
+		parser = LangParser(fileName)
+		ruleList = parser.parseFile()
+		if parser.errors:
+			raise RuleValidationException("Could not load [" + fileName + "]:\n" +
+				"\n".join([str(error) for error in parser.errors]))
+		base = None
+		if parser.base != None:
+			self.loading.append(locale)
+			try:
+				base = self.load(parser.base)
+			finally:
+				self.loading.pop()
+			ruleList.inherit(base.ruleList)
+		engine = RuleEngine(ruleList)
+		if self.warmSetFileName != None:
+			if self.warmSet == None:
+				self.warmSet = readWarmSet(self.warmSetFileName)
+			engine.preload([value for entryLocale, value, count in self.warmSet 
+				if entryLocale == locale], self.warmMaxBytes)
+		self.engines[locale] = engine
+		return engine
+
+	def loadAll(self):
+		"""Loads every .lang file in the directory, returning a dict of 
+			RuleEngines by locale.
+		"""
+		for fileName in sorted(os.listdir(self.path or ".")):
+			if fileName.endswith(".lang"):
+				self.load(fileName[:-len(".lang")])
+		return self.engines
+
+def readWarmSet(fileName, locale=None):
+	"""Reads a warm set written by writeWarmSet() in naturalnum.py.  If 
+		'locale' is given, returns just its values (most frequent first), for
+		RuleEngine.preload().
+	"""
+	warmSet = []
+	f = open(fileName, 'r')
+	try:
+		for line in f:
+			fields = line.rstrip("\n").split("\t")
+			if len(fields) == 3:
+				warmSet.append((fields[0], fields[1], int(fields[2])))
+	finally:
+		f.close()
+	if locale == None:
+		return warmSet
+	return [value for entryLocale, value, count in warmSet if entryLocale == locale]
+
+def compileTemplate(template):
+	"""Compiles an rhs token with backreferences (e.g. '\\g<1>0') into a tuple
+		of literal strings and 0-based group indexes, for expandTemplate().  A
+		token without backreferences is returned unchanged, as a string.
+	"""
+	pieces = backrefPattern.split(template)
+	if len(pieces) == 1:
+		return template
+	compiled = []
+	for i, piece in enumerate(pieces):
+		if i % 2 == 1:
+			compiled.append(int(piece) - 1)
+		elif piece != "":
+			compiled.append(piece)
+	return tuple(compiled)
+
+def expandTemplate(template, groups):
+	"""Expands a template from compileTemplate() with the groups of a match."""
+	if template.__class__ is str:
+		return template
+	return "".join([groups[x] if x.__class__ is int else x for x in template])
+
+def validateAndParseDirective(line):
+	"""Parses a rendering directive line of the form '@<name>=<value>', e.g.:
+		@separator=" "
+		The value may be enclosed in double quotes, to allow spaces or an empty
+		value.  Any characters after '#' are ignored.
+
+		Return values:
+		- If the line is a valid directive, a (name, value) tuple
+		- If the line starts with '@' but is invalid, a RuleValidationException
+		  will be raised
+		- If the line is not a directive, None will be returned
+	"""
+	line = line.lstrip()
+	if line[0:1] != '@':
+		return None
+	commentCharPos = line.find('#')
+	if commentCharPos != -1:
+		line = line[:commentCharPos]
+	match = re.match(directiveValidatorRegex, line.rstrip())
+	if match == None or (match.group(1) not in directiveDefaults and 
+			match.group(1) != baseDirective):
+		raise RuleValidationException("Could not validate directive: [" +
+			line.rstrip() + "].  Known directives are: " +
+			", ".join(sorted(list(directiveDefaults) + [baseDirective])))
+	value = match.group(2)
+	if len(value) >= 2 and value[0] == '"' and value[-1] == '"':
+		value = value[1:-1]
+	return (match.group(1), value)
 
 def validateAndParseRule(rule):
 	"""Validates and parses entire rule string, returning it as a Rule object.  
@@ -313,8 +815,6 @@ def validateAndParseRule(rule):
 		- If rule is invalid, a RuleValidationException will be raised
 		- If rule was only a comment, None will be returned
 	"""
-	logger.debug("validateAndParseRule()")
-
 	# Get rule without comments, return None if rule is only a comment
 	commentCharPos = rule.find('#')
 	if commentCharPos != -1:
@@ -327,7 +827,7 @@ def validateAndParseRule(rule):
 	# Check that rule without comment is some chars, delimited by '='
 	if (re.match(ruleValidatorRegex, ruleWithoutComment) == None):
 		raise RuleValidationException("Could not validate rule: [" + 
-			rule + "].  Format should be: <lhs>=<rhs>")
+			rule.rstrip() + "].  Format should be: <lhs>=<rhs>", 0)
 
 	# Split rule into LHS and RHS, create Rule object and run its validations
 	parts = ruleWithoutComment.split('=')
@@ -1,43 +1,62 @@
 import cgi
 import os
-import glob
 
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp.util import run_wsgi_app
-from os.path import basename
 
 from naturalnum import *
 
 ## Rule Engines, by locale code (e.g. 'en_GB')
 engines = {}
 
-## Build the Rule Engines by scanning the config file directory
+## Limits on the work done for one request
+budget = ResolutionBudget(maxInputLength=30, maxRulesScanned=20000,
+	maxRecursionSteps=200, deadline=0.05)
+
+## The most requested values, resolved at startup if present (build it from
+## the access logs with warmset.py), and the memory to spend on them per locale.
+## Not .txt, which app.yaml serves as a static file, out of the app's reach.
+warmSetFileName = 'warmset.tsv'
+warmMaxBytes = 1000000
+if not os.path.exists(warmSetFileName):
+    warmSetFileName = None
+
+## Build the Rule Engines by scanning the config file directory (regional 
+## variants share structure with their base locale)
 path = 'config/'
-for infile in glob.glob( os.path.join(path, '*.lang') ):
-    lang = os.path.splitext(basename(infile))[0]
-    eng = RuleEngine.fromLangFilename(infile)
-    engines[lang] = eng
+engines.update(LangLoader(path, warmSetFileName, warmMaxBytes).loadAll())
+for eng in engines.values():
+    eng.setBudget(budget)
 
 def callNaturalNum(docRoot, lang, value):
    """ Delegates look-up of natural language represention of digits entered,
-       by calling NaturalNum. """
+       by calling NaturalNum.  The result holds the tokens and the value as 
+       rendered for the locale, e.g. "vingt-deux" (see RuleEngine.render). """
 
    eng = engines[lang]
-   return tokensToJson(eng.resolve(value))
+   tokens = eng.resolve(value)
+   if tokens == None:
+      raise RuleEvaluationException("No rule matches [" + value + "]")
+   return resultToJson(tokens, eng.render(value))
 
-def tokensToJson(tokens):
-   """ Converts the list of strings returned by NaturalNum to JSON."""
+def resultToJson(tokens, text):
+   """ Converts the list of strings returned by NaturalNum, and the rendered
+       string, to JSON."""
    json = '{"tokens": ['
 
    for token in tokens:
-      json = json + '"' + token + '", '
+      json = json + jsonString(token) + ', '
 
-   # Append trailing closing array bracket and closing outer curly bracket
-   # We strip off the last 2 chars of the json because it will contain an
-   # extra unnecessary trailing comma and space.
-   json = json[0:-2] + ']}'
+   # Strip off the last 2 chars of the json because they will be an extra
+   # unnecessary trailing comma and space, then close the array and add the
+   # rendered string.
+   json = json[0:-2] + '], "text": ' + jsonString(text) + '}'
    return json
 
+def jsonString(s):
+   """ Quotes 's' as a JSON string. """
+   return '"' + s.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
 # Handles requests for JSON representing a list of natural language tokens, 
 # based on a numeric value
 class JsonHandler (webapp.RequestHandler):
@@ -45,7 +64,16 @@ class JsonHandler (webapp.RequestHandler):
 		lang = self.request.get('lang')
 		value = self.request.get('value')
 		docRoot = '.'
-		json = callNaturalNum(docRoot, lang, value)
+		if lang not in engines:
+			self.error(400)
+			self.response.out.write('{"error": "unknown language"}')
+			return
+		try:
+			json = callNaturalNum(docRoot, lang, value)
+		except (RuleUsageException, RuleEvaluationException):
+			self.error(400)
+			self.response.out.write('{"error": "value not accepted"}')
+			return
 		self.response.out.write(json)
 
 application = webapp.WSGIApplication(
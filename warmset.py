@@ -0,0 +1,61 @@
+from naturalnum import *
+import sys
+
+def warmset():
+	"""Builds a warm set file for RuleEngine.preload() from nnjson.py access
+		logs or value histograms (see parseRequest), or reports how much of 
+		the traffic in some logs an existing warm set covers.  nnjson.py 
+		preloads site/warmset.tsv, if present.
+	"""
+	if len(sys.argv) < 4 or sys.argv[1] not in ("build", "report"):
+		usage()
+		return 2
+	warmFileName = sys.argv[2]
+	args = sys.argv[3:]
+	maxEntries = None
+	if args[0] == "--top" and len(args) > 2:
+		maxEntries = int(args[1])
+		args = args[2:]
+	counts = {}
+	skipped = 0
+	for logFileName in args:
+		f = open(logFileName, 'r')
+		for line in f:
+			request = parseRequest(line)
+			if request == None:
+				skipped = skipped + 1
+				continue
+			key = request[0:2]
+			counts[key] = counts.get(key, 0) + request[2]
+		f.close()
+	if skipped:
+		print(str(skipped) + " lines skipped: not a successful request with " + 
+			"'lang' and 'value' parameters, or a '<locale> <value> <count>' line")
+	if sys.argv[1] == "build":
+		writeWarmSet(warmFileName, buildWarmSet(counts, maxEntries))
+		warmSet = readWarmSet(warmFileName)
+	else:
+		warmSet = buildWarmSet(dict([((l, v), c) for l, v, c in readWarmSet(warmFileName)]), 
+			maxEntries)
+	report(warmSet, counts)
+	return 0
+
+def report(warmSet, counts):
+	coverage = warmSetCoverage(warmSet, counts)
+	allCovered = 0
+	allTotal = 0
+	for locale in sorted(coverage):
+		covered, total = coverage[locale]
+		allCovered = allCovered + covered
+		allTotal = allTotal + total
+		print(locale + ": " + str(covered) + "/" + str(total) + " requests covered (" + 
+			"%.1f" % (100.0 * covered / total) + "%)")
+	print("all: " + str(len(warmSet)) + " warm values cover " + str(allCovered) + "/" + 
+		str(allTotal) + " requests (" + "%.1f" % (100.0 * allCovered / max(allTotal, 1)) + "%)")
+
+def usage():
+	print("Usage: warmset.py build <warm set file> [--top <n>] <log file> [<log file> ...]")
+	print("       warmset.py report <warm set file> [--top <n>] <log file> [<log file> ...]")
+
+if __name__ == '__main__':
+	sys.exit(warmset())